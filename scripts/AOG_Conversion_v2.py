@@ -8,7 +8,7 @@
 
 """
 
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsProcessing,
                        QgsFeatureSink,
                        QgsProcessingException,
@@ -22,14 +22,44 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterMapLayer,
                        QgsProcessingParameterNumber,
                        QgsProcessingParameterColor,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterBoolean,
                        QgsCoordinateReferenceSystem,
                        QgsProcessingUtils,
                        QgsCoordinateReferenceSystem,
+                       QgsFeatureRequest,
+                       QgsCoordinateTransform,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsWkbTypes,
+                       QgsSpatialIndex,
+                       QgsRectangle,
+                       QgsRasterLayer,
                        QgsProject)
-from qgis import processing
-from math import cos
+import os
+import struct
+import sys
+import time
+import numpy as np
 from qgis.PyQt.QtGui import QColor
 
+# the core library aogsections lives next to this script
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from aogsections.cellset import CellSet  # noqa: E402
+from aogsections.geometry import CellGrid, polygonWkb, wkbPolygons, wkbRingLayout  # noqa: E402
+from aogsections.fieldfiles import readStartFix  # noqa: E402
+from aogsections.localframe import LocalFrame  # noqa: E402
+from aogsections.pipeline import (ENGINE_QUADTREE, ENGINE_RASTER_MASK, checkGridSizes, polygonBounds,  # noqa: E402
+                                  sectionCells, updateSections)
+from aogsections.sections import CHUNK_SIZE, SectionsWriter, readSections, rectCorners, stripStarts  # noqa: E402
+from aogsections.tiling import generateTiledSections  # noqa: E402
+from aogsections.weedraster import DEFAULT_THRESHOLD, WeedRaster  # noqa: E402
+from aogsections.profiling import StepProfiler, polygonVertexCount  # noqa: E402
+
 
 class AgSectionFileCreator(QgsProcessingAlgorithm):
     """
@@ -47,17 +77,37 @@ class AgSectionFileCreator(QgsProcessingAlgorithm):
     INPUT_WEED_LAYER = 'Unkrautflchen'
     INPUT_COLOR = 'Color'
     INPUT_GRID_CRS = 'GridCrs'
+    INPUT_ENGINE = 'Engine'
+    INPUT_MERGE_STRIPS = 'MergeStrips'
+    INPUT_LOCAL_GRID = 'LocalGrid'
+    INPUT_CACHE_FOLDER = 'CacheFolder'
+    INPUT_TILE_SIZE = 'TileSize'
+    INPUT_PROFILE = 'Profile'
+    INPUT_PROFILE_FILE = 'ProfileFile'
+    INPUT_SKIP_APPLIED = 'SkipApplied'
+    INPUT_KEEP_EXISTING = 'KeepExisting'
+    INPUT_SIMPLIFY_WEEDS = 'SimplifyWeeds'
+    INPUT_WEED_THRESHOLD = 'WeedThreshold'
     OUTPUT_SECTIONS_LAYER = 'Sections_joined'  
 
     INPUT = 'INPUT'
     OUTPUT_SECTION_FILE = 'OUTPUT_SECTION_FILE'
     INPUT_FIELDS_FILE = 'INPUT_FIELDS_FILE'
 
-    mPerDegreeLat = 0.0
-    mPerDegreeLon = 0.0
-    latStart = 48.9636327590282  # default start latitude
-    lonStart = 12.1934211840036  # default start longitude
     count = 0
+    patchCount = 0
+
+    # Export of Sections.txt: number of cells converted per batch
+    EXPORT_CHUNK_SIZE = CHUNK_SIZE
+    # cells whose bounding boxes are compared with those of the weeds at once
+    CANDIDATE_BLOCK_SIZE = 1024
+    # Engines to calculate the sections
+    ENGINE_VECTOR = 0
+    ENGINE_RASTER_MASK = 1
+    ENGINE_QUADTREE = 2
+
+    # tolerance for dissolving and simplifying the weeds, as fraction of the small grid size
+    WEED_TOLERANCE = 0.25
 
     def tr(self, string):
         """
@@ -114,9 +164,20 @@ class AgSectionFileCreator(QgsProcessingAlgorithm):
         <a href=https://github.com/joschindlbeck/aog_qgis>Github</a>
         Expected Input:
         <b>Field Boundary</b>: Vector Layer with a polygon representing the field boundary. A vector layer generated from Field.kml from AGOOpenGPS works best
-        <b>Layer with weeds</b>: Vector Layer with multiple polygons representing the weed spots that shall be applied in AGOpenGPS; the script will mark all other areas within the field boundaries as already applied
+        <b>Layer with weeds</b>: Vector Layer with multiple polygons representing the weed spots that shall be applied in AGOpenGPS; the script will mark all other areas within the field boundaries as already applied. With the Raster mask or Quadtree engine, this can also be a raster file (e.g. a weed probability GeoTIFF from a drone), which is read block by block without polygonizing it
+        <b>Weed raster threshold</b>: Pixels of a weed raster with a value at or above the threshold are weeds; every cell touched by such a pixel is left for application
         <b>Grid size small / large</b>: To fill the applied areas, the script will generate a grid / quadrats of two different sizes; the size can be entered, however the large size must be a multiple of the small size
         <b>Grid CRS</b>: For the grid calculation, we need a non geographic CRS
+        <b>Grid in AOG local coordinates</b>: Instead of the Grid CRS, calculate the grid in the local coordinates of AOG, based on the StartFix of the AOG Fields file; the cells are aligned with AOG and written without further conversion (Raster mask and Quadtree engine only)
+        <b>Engine</b>: Vector overlay tests the cells with the exact QGIS geometry predicates against field boundary and weeds; the cells are kept as grid indices, their bounding boxes are compared in bulk first, so cells beyond the field boundary extent are dropped without a geometry and every other cell is only tested against the weeds its bounding box hits; Raster mask rasterizes field boundary and weeds into a cell mask and only creates the cells that end up in the sections, which is much faster and needs less memory on large fields; Quadtree uses the raster mask, but instead of two fixed grid sizes it starts with the largest power of two multiple of the small grid size and only subdivides cells touching weeds or the field boundary (the large grid size is not used)
+        <b>Merge cells to strips</b>: Adjacent cells of the same size in a row are written as one triangle strip patch to Sections.txt, which makes the file smaller and faster to load in AOG
+        <b>Dissolve and simplify weeds</b>: Overlapping weed polygons are merged, grown by half of the small grid size and simplified with a quarter of it before the overlay; every simplified weed is checked to cover all of the original weed area (otherwise it is kept unsimplified), but has far fewer vertices, which speeds up weed layers with many dense, overlapping polygons (e.g. from trackers or drone detections)
+        <b>Tile size</b>: With a tile size in meters (rounded up to a multiple of the large grid), the field is classified in square tiles and the cells of every tile are written right away, so the memory needed depends on the tile size instead of the field size; for very large fields with a fine grid (Raster mask and Quadtree engine only)
+        <b>Cache folder</b>: Optional folder for a cache per field (Raster mask and Quadtree engine only); when the script runs again for the same field boundary, StartFix, grid CRS and grid sizes, only the cells around weeds that were added, removed or changed are recalculated and the rest of Sections.txt is copied from the last run
+        <b>Skip cells applied in Sections.txt</b>: If the Sections.txt output file exists, cells already covered by its patches are not written again and its patches are kept, e.g. to add only the newly applied area of a second pass (Raster mask and Quadtree engine with the grid in AOG local coordinates only)
+        <b>Keep existing patches of Sections.txt</b>: If the Sections.txt output file exists, its patches are copied to the new file before the new cells, so the file is extended instead of replaced (not together with the cache folder)
+        <b>Profile steps</b>: Records wall time, CPU time, input / output feature and vertex counts and the peak memory of every step and shows them as table in the log; counting the features and vertices takes some extra time
+        <b>Write profile next to Sections.txt</b>: Also writes the profile as JSON file (Sections_profile.json for Sections.txt)
         <b>AOG Fields file</b>: Path to the AOG Fields.txt file; this is needed to get the base coordinates that AOG uses internally
         <b>Applied Sections Color</b>: The color to be used for the section patches in AOG that are already applied
         <b>Sections Layer</b>: This is the output layer of the script operation and represents the already applied area for AOG
@@ -134,16 +195,47 @@ class AgSectionFileCreator(QgsProcessingAlgorithm):
         # Vector layer with field boundary polygon
         self.addParameter(QgsProcessingParameterMapLayer(self.INPUT_FIELD_BOUNDARY, self.tr(
             'Field Boundary'), defaultValue=None, types=[QgsProcessing.TypeVectorPolygon]))
-        # Vector layer with weed polygons
+        # Vector layer with weed polygons or raster with weed probabilities
         self.addParameter(QgsProcessingParameterMapLayer(self.INPUT_WEED_LAYER, self.tr(
-            'Layer with weeds'), defaultValue=None, types=[QgsProcessing.TypeVectorPolygon]))
+            'Layer with weeds'), defaultValue=None, types=[QgsProcessing.TypeVectorPolygon, QgsProcessing.TypeRaster]))
+        self.addParameter(QgsProcessingParameterNumber(self.INPUT_WEED_THRESHOLD, self.tr(
+            'Weed raster threshold'), type=QgsProcessingParameterNumber.Double, defaultValue=DEFAULT_THRESHOLD))
         # Crs for grids
         self.addParameter(QgsProcessingParameterCrs(self.INPUT_GRID_CRS, self.tr('Grid CRS'), defaultValue='ProjectCrs'))
+        # Grid in AOG local frame
+        self.addParameter(QgsProcessingParameterBoolean(self.INPUT_LOCAL_GRID, self.tr(
+            'Grid in AOG local coordinates'), defaultValue=False))
         # Size of grids
         self.addParameter(QgsProcessingParameterNumber(self.INPUT_GRID_SMALL, self.tr(
             'Size for small grid'), type=QgsProcessingParameterNumber.Double, defaultValue=1))
         self.addParameter(QgsProcessingParameterNumber(self.INPUT_GRID_LARGE, self.tr(
             'Size for large grid'), type=QgsProcessingParameterNumber.Double, defaultValue=10))
+        # Engine for the section calculation
+        self.addParameter(QgsProcessingParameterEnum(self.INPUT_ENGINE, self.tr('Engine'), options=[
+            self.tr('Vector overlay'), self.tr('Raster mask'), self.tr('Quadtree (raster mask)')],
+            defaultValue=self.ENGINE_VECTOR))
+        # Merge adjacent cells to strip patches
+        self.addParameter(QgsProcessingParameterBoolean(self.INPUT_MERGE_STRIPS, self.tr(
+            'Merge cells to strips'), defaultValue=True))
+        # Preprocessing of the weeds
+        self.addParameter(QgsProcessingParameterBoolean(self.INPUT_SIMPLIFY_WEEDS, self.tr(
+            'Dissolve and simplify weeds'), defaultValue=False))
+        # Tiles for large fields
+        self.addParameter(QgsProcessingParameterNumber(self.INPUT_TILE_SIZE, self.tr(
+            'Tile size (0 = no tiles)'), type=QgsProcessingParameterNumber.Double, defaultValue=0, minValue=0))
+        # Cache folder for incremental regeneration
+        self.addParameter(QgsProcessingParameterFile(self.INPUT_CACHE_FOLDER, self.tr('Cache folder'),
+                                                     behavior=QgsProcessingParameterFile.Folder, optional=True))
+        # Existing Sections.txt at the output path
+        self.addParameter(QgsProcessingParameterBoolean(self.INPUT_SKIP_APPLIED, self.tr(
+            'Skip cells applied in Sections.txt'), defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean(self.INPUT_KEEP_EXISTING, self.tr(
+            'Keep existing patches of Sections.txt'), defaultValue=False))
+        # Profiling of the steps
+        self.addParameter(QgsProcessingParameterBoolean(self.INPUT_PROFILE, self.tr(
+            'Profile steps'), defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean(self.INPUT_PROFILE_FILE, self.tr(
+            'Write profile next to Sections.txt'), defaultValue=False))
         # Input File Fields.txt from AGOpenGPS for
         self.addParameter(QgsProcessingParameterFile(
             self.INPUT_FIELDS_FILE, self.tr('AOG Fields file')))
@@ -162,155 +254,606 @@ class AgSectionFileCreator(QgsProcessingAlgorithm):
         """
         Here is where the processing itself takes place.
         """
-        feedback = QgsProcessingMultiStepFeedback(8, model_feedback)
+        feedback = QgsProcessingMultiStepFeedback(5, model_feedback)
         results = {}
-        outputs = {}
-
-        # -- Temporary outputs
-        OUT_LARGE_GRID = 'GrobesGitterErzeugen'
-        OUT_SMALL_GRID = 'FeinesGitterErzeugen'
-        OUT_AREA_WO_WEEDS = 'UnkrautfreieFlcheErzeugen'
-        OUT_EXT_FIELD_BOUNDARY = 'FeldgrenzeExtrahieren'
-        OUT_EXT_SMALL_GRID = 'ExtrahiereFeinesGitter'
-        OUT_EXT_LARGE_GRID = 'ExtrahiereGrobeGitter'
-        OUT_DIFF_LARGE_SMALL_SECT = 'DifferenzAusSectionsGrobUndFein'
 
         # -- Step 0: Checks
         # is grid small a multiple of grid large?
         grid_small = self.parameterAsDouble(parameters, self.INPUT_GRID_SMALL, context)
         grid_large = self.parameterAsDouble(parameters, self.INPUT_GRID_LARGE, context)
-        if grid_large % grid_small != 0:
-            # not a multiple
-            raise QgsProcessingException("Size of grid small must be a multiple of the size of grid large!")
+        try:
+            checkGridSizes(grid_small, grid_large)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
         
         # Check CRS
         crs: QgsCoordinateReferenceSystem = self.parameterAsCrs(parameters, self.INPUT_GRID_CRS, context)
-        if crs.isGeographic():
+        localGrid = self.parameterAsBool(parameters, self.INPUT_LOCAL_GRID, context)
+        if crs.isGeographic() and not localGrid:
             # we must use a projected CRS for grid calculation!
             raise QgsProcessingException("Geographic CRS for Grid not allowed! Must be a projected one")
 
-
-        # -- Step 1: Create large grid within field boundary
-        alg_params = {
-            'CRS': 'ProjectCrs',
-            'EXTENT': parameters[self.INPUT_FIELD_BOUNDARY],
-            'HOVERLAY': 0,
-            'HSPACING': parameters[self.INPUT_GRID_LARGE],
-            'TYPE': 2,  # Rechteck (Polygon)
-            'VOVERLAY': 0,
-            'VSPACING': parameters[self.INPUT_GRID_LARGE],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs[OUT_LARGE_GRID] = processing.run('native:creategrid', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        profiler = StepProfiler(self.parameterAsBool(parameters, self.INPUT_PROFILE, context)
+                                or self.parameterAsBool(parameters, self.INPUT_PROFILE_FILE, context))
+        if self.parameterAsEnum(parameters, self.INPUT_ENGINE, context) in (self.ENGINE_RASTER_MASK, self.ENGINE_QUADTREE):
+            results = self.processRasterMask(parameters, context, model_feedback, profiler)
+            self.reportProfile(profiler, parameters, context, model_feedback, results)
+            return results
+        if localGrid:
+            raise QgsProcessingException("Grid in AOG local coordinates needs the Raster mask or Quadtree engine")
+        if self.parameterAsFile(parameters, self.INPUT_CACHE_FOLDER, context):
+            raise QgsProcessingException("Cache folder needs the Raster mask or Quadtree engine")
+        if self.parameterAsDouble(parameters, self.INPUT_TILE_SIZE, context) > 0:
+            raise QgsProcessingException("Tiles need the Raster mask or Quadtree engine")
+        if self.parameterAsBool(parameters, self.INPUT_SKIP_APPLIED, context):
+            raise QgsProcessingException("Skipping applied cells needs the Raster mask or Quadtree engine")
+        if isinstance(self.parameterAsLayer(parameters, self.INPUT_WEED_LAYER, context), QgsRasterLayer):
+            raise QgsProcessingException("Weed rasters need the Raster mask or Quadtree engine")
+
+        boundaryLayer = self.parameterAsLayer(parameters, self.INPUT_FIELD_BOUNDARY, context)
+        weedLayer = self.parameterAsLayer(parameters, self.INPUT_WEED_LAYER, context)
+        wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+
+        # -- Step 1: Small and large grid over the extent of the field boundary in the grid CRS, like
+        # the other engines; the cells are kept as row / column indices (see CellSet), cell
+        # polygons are only created to test them and for the sections layer
+        profiler.start('1 Create grids')
+        rect = self.parameterAsExtent(parameters, self.INPUT_FIELD_BOUNDARY, context, crs)
+        grid = CellGrid.fromExtent(rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum(), grid_small)
+        spans = (1, int(round(grid_large / grid_small)))
+        largeCells = CellSet.full(grid, 1, spans)
+        profiler.count(inputFeatures=boundaryLayer.featureCount(), outputFeatures=len(largeCells))
 
         feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
 
-        # -- Step 2: Create area without wees as difference between Layer weeds and field boundaries
-        alg_params = {
-            'INPUT': parameters[self.INPUT_FIELD_BOUNDARY],
-            'OVERLAY': parameters[self.INPUT_WEED_LAYER],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs[OUT_AREA_WO_WEEDS] = processing.run('native:difference', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # -- Step 2: Bounding boxes of the weed polygons; instead of testing the cells against
+        # field boundary minus weeds (with a hole for every weed), each cell is only tested
+        # against the weeds its bounding box hits
+        profiler.start('2 Bounding boxes of weeds')
+        weedIndex = self.weedIndex(parameters, context, crs, feedback)
+        self.profileLayers(profiler, context, [boundaryLayer, weedLayer])
 
         feedback.setCurrentStep(2)
         if feedback.isCanceled():
             return {}
 
-        # -- Step 3: Create small grid within field boundary
-        alg_params = {
-            'CRS': 'ProjectCrs',
-            'EXTENT': parameters[self.INPUT_FIELD_BOUNDARY],
-            'HOVERLAY': 0,
-            'HSPACING': parameters[self.INPUT_GRID_SMALL],
-            'TYPE': 2,  # Rechteck (Polygon)
-            'VOVERLAY': 0,
-            'VSPACING': parameters[self.INPUT_GRID_SMALL],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs[OUT_SMALL_GRID] = processing.run('native:creategrid', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # -- Step 3: Extract large grid within field boundary minus weeds
+        profiler.start('3 Extract large cells')
+        large, _ = self.classifyCells(largeCells, weedIndex, 'Large grid', feedback)
+        profiler.count(inputFeatures=len(largeCells), outputFeatures=len(large))
 
         feedback.setCurrentStep(3)
         if feedback.isCanceled():
             return {}
 
-        # -- Step 4: Extract field boundaries
-        alg_params = {
-            'INPUT': outputs[OUT_SMALL_GRID]['OUTPUT'],
-            'INTERSECT': parameters[self.INPUT_FIELD_BOUNDARY],
-            'PREDICATE': [5],  # überlappt
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs[OUT_EXT_FIELD_BOUNDARY] = processing.run('native:extractbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # -- Step 4: Extract small grid within field boundary minus weeds and the small cells on the
+        # field boundary; the difference to the large cells is taken on the indices beforehand,
+        # so only the small cells of the large cells that are not free are created and tested
+        profiler.start('4 Extract small and field boundary cells')
+        smallCells = largeCells.difference(large).split(0)
+        small, edge = self.classifyCells(smallCells, weedIndex, 'Small grid', feedback, boundaryCells=True)
+        profiler.count(inputFeatures=len(smallCells), outputFeatures=len(small) + len(edge))
 
         feedback.setCurrentStep(4)
         if feedback.isCanceled():
             return {}
 
-        # -- Step 5: Extract small grid
-        alg_params = {
-            'INPUT': outputs[OUT_SMALL_GRID]['OUTPUT'],
-            'INTERSECT': outputs[OUT_AREA_WO_WEEDS]['OUTPUT'],
-            'PREDICATE': [6],  # sind innerhalb
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs[OUT_EXT_SMALL_GRID] = processing.run('native:extractbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(5)
-        if feedback.isCanceled():
+        # -- Step 5: Merge sections large, small and those on field boundary, write them to the
+        # sections layer and Sections.txt; cells of the same size row by row for strip patches
+        profiler.start('5 Write sections')
+        cells = large.union(small, edge).sorted()
+        feedback.pushInfo("Vector overlay: {} large cells, {} small cells, {} cells on field boundary "
+                          "({} bytes as cell set)".format(len(large), len(small), len(edge), cells.nbytes))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT_SECTIONS_LAYER, context,
+                                               self.cellFields(), QgsWkbTypes.Polygon, wgs84)
+        mergeStrips = self.parameterAsBool(parameters, self.INPUT_MERGE_STRIPS, context)
+        transform = QgsCoordinateTransform(crs, wgs84, context.transformContext())
+        file = self.writeSectionsFile(parameters, context, self.rectCellChunks(cells, transform, sink, mergeStrips),
+                                      len(cells), feedback)
+        if file is None:
             return {}
+        profiler.count(inputFeatures=len(cells), outputFeatures=self.patchCount, outputVertices=self.count)
 
-        # -- Step 6: Extract large grid
-        alg_params = {
-            'INPUT': outputs[OUT_LARGE_GRID]['OUTPUT'],
-            'INTERSECT': outputs[OUT_AREA_WO_WEEDS]['OUTPUT'],
-            'PREDICATE': [6],  # sind innerhalb
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs[OUT_EXT_LARGE_GRID] = processing.run('native:extractbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        if sink is not None:
+            results[self.OUTPUT_SECTIONS_LAYER] = dest_id
+        results[self.OUTPUT_SECTION_FILE] = file
+        self.reportProfile(profiler, parameters, context, model_feedback, results)
+        return results
 
-        feedback.setCurrentStep(6)
+    def weedIndex(self, parameters, context, crs, feedback):
+        """
+        Returns the prepared field boundary and its bounding box, the bounding boxes of the weed
+        polygons as array of shape (n, 4) with xmin, ymin, xmax, ymax and the prepared weed
+        polygons by row of that array, all in crs
+        """
+        start = time.perf_counter()
+        boundaryLayer = self.parameterAsLayer(parameters, self.INPUT_FIELD_BOUNDARY, context)
+        transform = QgsCoordinateTransform(boundaryLayer.crs(), crs, context.transformContext())
+        boundary = QgsGeometry.unaryUnion([feature.geometry() for feature in boundaryLayer.getFeatures(
+            QgsFeatureRequest().setNoAttributes()) if feature.hasGeometry()])
+        if boundary.isEmpty():
+            raise QgsProcessingException("No field boundary polygon")
+        boundary.transform(transform)
+        boundaryEngine = QgsGeometry.createGeometryEngine(boundary.constGet())
+        boundaryEngine.prepareGeometry()
+
+        weedLayer = self.parameterAsLayer(parameters, self.INPUT_WEED_LAYER, context)
+        transform = QgsCoordinateTransform(weedLayer.crs(), crs, context.transformContext())
+        geometries = []
+        for feature in weedLayer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if not feature.hasGeometry():
+                continue
+            geometry = QgsGeometry(feature.geometry())
+            geometry.transform(transform)
+            geometries.append(geometry)
+        if self.parameterAsBool(parameters, self.INPUT_SIMPLIFY_WEEDS, context):
+            geometries = self.preprocessWeeds(geometries, self.weedTolerance(parameters, context), feedback)
+        weeds = {}
+        boxes = np.empty((len(geometries), 4))
+        for id, geometry in enumerate(geometries):
+            weed = QgsGeometry.createGeometryEngine(geometry.constGet())
+            weed.prepareGeometry()
+            weeds[id] = (geometry, weed)
+            box = geometry.boundingBox()
+            boxes[id] = (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())
+        box = boundary.boundingBox()
+        boundaryBox = (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())
+        feedback.pushInfo("{} weed polygons prepared in {:.2f} s".format(len(weeds), time.perf_counter() - start))
+        return boundaryEngine, boundaryBox, boxes, weeds
+
+    def polygonGeometry(self, polygon):
+        """
+        Returns a polygon given as list of rings as QgsGeometry
+        """
+        geometry = QgsGeometry()
+        geometry.fromWkb(polygonWkb(polygon))
+        return geometry
+
+    def weedTolerance(self, parameters, context):
+        return self.parameterAsDouble(parameters, self.INPUT_GRID_SMALL, context) * self.WEED_TOLERANCE
+
+    def preprocessWeeds(self, geometries, tolerance, feedback):
+        """
+        Dissolves overlapping weed polygons, grows them by twice the tolerance and simplifies them
+        with the tolerance. Douglas-Peucker can move the outline by more than the tolerance (e.g.
+        at the ring start or where mitered joins meet), so every simplified weed is checked to
+        contain the original one; if it does not, the grown weed is used unsimplified.
+        Returns the list of new weed geometries
+        """
+        start = time.perf_counter()
+        vertices = sum(geometry.constGet().nCoordinates() for geometry in geometries)
+        # groups of overlapping weeds (union find), candidates from a spatial index
+        index = QgsSpatialIndex()
+        for id, geometry in enumerate(geometries):
+            index.addFeature(id, geometry.boundingBox())
+        parent = list(range(len(geometries)))
+
+        def root(id):
+            while parent[id] != id:
+                parent[id] = parent[parent[id]]
+                id = parent[id]
+            return id
+
+        for id, geometry in enumerate(geometries):
+            engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+            engine.prepareGeometry()
+            for other in index.intersects(geometry.boundingBox()):
+                if other > id and root(other) != root(id) and engine.intersects(geometries[other].constGet()):
+                    parent[root(other)] = root(id)
+        groups = {}
+        for id, geometry in enumerate(geometries):
+            groups.setdefault(root(id), []).append(geometry)
+
+        weeds = []
+        fallbacks = 0
+        for group in groups.values():
+            original = group[0] if len(group) == 1 else QgsGeometry.unaryUnion(group)
+            # mitered joins keep the grown outline at least twice the tolerance away from the weed
+            grown = original.buffer(2 * tolerance, 1, QgsGeometry.CapFlat, QgsGeometry.JoinStyleMiter, 2.0)
+            geometry = grown.simplify(tolerance)
+            if geometry.isEmpty() or not geometry.contains(original):
+                # a weed must never lose area, cells touching only the lost part would be applied
+                fallbacks += 1
+                geometry = grown
+            if not geometry.isEmpty():
+                weeds.append(geometry)
+        simplified = sum(geometry.constGet().nCoordinates() for geometry in weeds)
+        feedback.pushInfo("Weeds dissolved from {} to {} polygons and simplified from {} to {} vertices "
+                          "({:.0%} less, {} kept unsimplified) in {:.2f} s".format(
+                              len(geometries), len(weeds), vertices, simplified,
+                              1 - simplified / vertices if vertices else 0, fallbacks, time.perf_counter() - start))
+        return weeds
+
+    def classifyCells(self, cells, weedIndex, name, feedback, boundaryCells=False):
+        """
+        Tests the cells of a CellSet against field boundary and weeds: a cell is free if it is
+        within the field boundary and its interior does not intersect the interior of a weed
+        polygon; with boundaryCells, the cells overlapping the field boundary are collected as
+        well (like native:extractbylocation with the predicate overlaps).
+        The bounding boxes are compared in bulk on the cell indices: cells beyond the extent of
+        the field boundary are dropped without a geometry, the others are tested with the
+        prepared field boundary and only against the weeds their bounding box hits.
+        Returns the free cells and the boundary cells as CellSets
+        """
+        start = time.perf_counter()
+        boundaryEngine, (xmin, ymin, xmax, ymax), weedBoxes, weeds = weedIndex
+        free = np.zeros(len(cells), dtype=bool)
+        edge = np.zeros(len(cells), dtype=bool)
+        total = 100.0 / len(cells) if len(cells) else 0
+        tested = 0
+        withoutCandidates = 0
+        for chunkStart in range(0, len(cells), self.EXPORT_CHUNK_SIZE):
+            if feedback.isCanceled():
+                break
+            rects = cells.rects(chunkStart, chunkStart + self.EXPORT_CHUNK_SIZE)
+            # cells beyond the extent of the field boundary are neither within nor overlapping it
+            near = np.flatnonzero((rects[:, 0] < xmax) & (rects[:, 2] > xmin)
+                                  & (rects[:, 3] < ymax) & (rects[:, 1] > ymin))
+            for blockStart in range(0, len(near), self.CANDIDATE_BLOCK_SIZE):
+                block = near[blockStart:blockStart + self.CANDIDATE_BLOCK_SIZE]
+                left, top, right, bottom = rects[block].T
+                # weeds reaching into the extent of the block, then the weeds hit by every cell
+                ids = np.flatnonzero((weedBoxes[:, 0] <= right.max()) & (weedBoxes[:, 2] >= left.min())
+                                     & (weedBoxes[:, 1] <= top.max()) & (weedBoxes[:, 3] >= bottom.min()))
+                boxes = weedBoxes[ids]
+                hits = (boxes[:, 0] <= right[:, None]) & (boxes[:, 2] >= left[:, None]) \
+                    & (boxes[:, 1] <= top[:, None]) & (boxes[:, 3] >= bottom[:, None])
+                tested = tested + len(block)
+                for current, rect, cellHits in zip((block + chunkStart).tolist(), rects[block].tolist(), hits):
+                    geometry = QgsGeometry.fromRect(QgsRectangle(rect[0], rect[3], rect[2], rect[1]))
+                    if not boundaryEngine.contains(geometry.constGet()):
+                        edge[current] = boundaryCells and boundaryEngine.overlaps(geometry.constGet())
+                        continue
+                    candidates = ids[cellHits].tolist()
+                    if not candidates:
+                        # fast path: no weed near this cell
+                        withoutCandidates = withoutCandidates + 1
+                        free[current] = True
+                    elif not any(weeds[id][1].relatePattern(geometry.constGet(), 'T********') for id in candidates):
+                        free[current] = True
+            feedback.setProgress(int(chunkStart * total))
+
+        feedback.pushInfo("{}: {} of {} cells within field boundary minus {} weed polygons, {} of them tested "
+                          "against the field boundary, {} without weed candidates, classified in {:.2f} s".format(
+                              name, int(free.sum()), len(cells), len(weeds), tested, withoutCandidates,
+                              time.perf_counter() - start))
+        return cells.subset(free), cells.subset(edge)
+
+    def processRasterMask(self, parameters, context, model_feedback, profiler):
+        """
+        Raster mask engine: rasterizes field boundary and weeds into a mask of small cells,
+        derives the large cells (or the quadtree cells) from blocks of the mask and writes
+        only the resulting cells
+        """
+        feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
+        results = {}
+
+        grid_small = self.parameterAsDouble(parameters, self.INPUT_GRID_SMALL, context)
+        grid_large = self.parameterAsDouble(parameters, self.INPUT_GRID_LARGE, context)
+        wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+        localGrid = self.parameterAsBool(parameters, self.INPUT_LOCAL_GRID, context)
+
+        # -- Step 1: Read field boundary and weeds in grid CRS or AOG local coordinates
+        profiler.start('1 Read layers')
+        boundaryLayer = self.parameterAsLayer(parameters, self.INPUT_FIELD_BOUNDARY, context)
+        weedLayer = self.parameterAsLayer(parameters, self.INPUT_WEED_LAYER, context)
+        weedRaster = isinstance(weedLayer, QgsRasterLayer)
+        if localGrid:
+            # every vertex is projected once into the local frame, the grid is anchored there
+            frame = self.fieldFrame(parameters, context, feedback)
+            boundary = frame.polygonsToLocal(self.readPolygons(boundaryLayer, wgs84, context))
+            if weedRaster:
+                weeds = self.weedRaster(parameters, context, weedLayer, frame=frame)
+            else:
+                weeds = frame.polygonsToLocal(self.readPolygons(weedLayer, wgs84, context))
+            extent = polygonBounds(boundary)
+        else:
+            crs = self.parameterAsCrs(parameters, self.INPUT_GRID_CRS, context)
+            boundary = self.readPolygons(boundaryLayer, crs, context)
+            if weedRaster:
+                weeds = self.weedRaster(parameters, context, weedLayer,
+                                        gridCrs=crs.toWkt(QgsCoordinateReferenceSystem.WKT_PREFERRED_GDAL))
+            else:
+                weeds = self.readPolygons(weedLayer, crs, context)
+            rect = self.parameterAsExtent(parameters, self.INPUT_FIELD_BOUNDARY, context, crs)
+            extent = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
+        if weedRaster:
+            # the raster is read for the cells later on
+            profiler.count(inputFeatures=boundaryLayer.featureCount(), outputFeatures=len(boundary),
+                           outputVertices=polygonVertexCount(boundary))
+        elif self.parameterAsBool(parameters, self.INPUT_SIMPLIFY_WEEDS, context):
+            # in grid coordinates, the tolerance is in meters there
+            weeds = self.preprocessWeeds([self.polygonGeometry(weed) for weed in weeds],
+                                         self.weedTolerance(parameters, context), feedback)
+            weeds = [polygon for weed in weeds for polygon in wkbPolygons(bytes(weed.asWkb()))]
+        if profiler.enabled and not weedRaster:
+            profiler.count(inputFeatures=boundaryLayer.featureCount() + weedLayer.featureCount(),
+                           outputFeatures=len(boundary) + len(weeds),
+                           outputVertices=polygonVertexCount(boundary) + polygonVertexCount(weeds))
+
+        feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
 
-        # -- Step 7: Difference between Sections large and small
-        alg_params = {
-            'INPUT': outputs[OUT_EXT_SMALL_GRID]['OUTPUT'],
-            'OVERLAY': outputs[OUT_EXT_LARGE_GRID]['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs[OUT_DIFF_LARGE_SMALL_SECT] = processing.run('native:difference', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        engine = ENGINE_QUADTREE if self.parameterAsEnum(parameters, self.INPUT_ENGINE, context) == self.ENGINE_QUADTREE \
+            else ENGINE_RASTER_MASK
+        cacheFolder = self.parameterAsFile(parameters, self.INPUT_CACHE_FOLDER, context)
+        tileSize = self.parameterAsDouble(parameters, self.INPUT_TILE_SIZE, context)
+        if cacheFolder and tileSize > 0:
+            raise QgsProcessingException("Cache folder and tile size can not be combined")
+        skipApplied = self.parameterAsBool(parameters, self.INPUT_SKIP_APPLIED, context)
+        if skipApplied and (not localGrid or tileSize > 0):
+            raise QgsProcessingException("Skipping applied cells needs the grid in AOG local coordinates and no tiles")
+        if cacheFolder and (skipApplied or self.parameterAsBool(parameters, self.INPUT_KEEP_EXISTING, context)):
+            raise QgsProcessingException("Cache folder and existing Sections.txt can not be combined")
+        if cacheFolder or tileSize > 0:
+            # -- Step 2 and 3: Recalculate cells around changed weeds (cache) or classify tile by tile,
+            # writing the cells directly to Sections.txt and the sections layer
+            if not localGrid:
+                frame = self.fieldFrame(parameters, context, feedback)
+                transform = QgsCoordinateTransform(crs, wgs84, context.transformContext())
+            profiler.start('2 Classify and write ({})'.format('cache' if cacheFolder else 'tiles'))
+            results = self.streamSectionsFile(parameters, context, boundary, weeds, extent, engine, frame,
+                                              None if localGrid else transform, feedback, cacheFolder, tileSize)
+            profiler.count(inputFeatures=len(boundary) + (0 if weedRaster else len(weeds)), outputFeatures=self.patchCount,
+                           outputVertices=self.count)
+            return results
+
+        # -- Step 2: Classify cells
+        profiler.start('2 Classify cells')
+        try:
+            patches = self.existingPatches(parameters, context, feedback) if skipApplied else None
+            cells = sectionCells(boundary, weeds, grid_small, grid_large, engine, extent=extent,
+                                 applied=patches.triangles() if patches is not None else None,
+                                 log=feedback.pushInfo)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        profiler.count(inputFeatures=len(boundary) + (0 if weedRaster else len(weeds)), outputFeatures=len(cells))
 
-        feedback.setCurrentStep(7)
+        feedback.setCurrentStep(2)
         if feedback.isCanceled():
             return {}
 
-        # -- Step 8: Merge sections large, small and those on field boundary
-        alg_params = {
-            'CRS': QgsCoordinateReferenceSystem('EPSG:4326'),
-            'LAYERS': [outputs[OUT_EXT_LARGE_GRID]['OUTPUT'],outputs[OUT_DIFF_LARGE_SMALL_SECT]['OUTPUT'],outputs[OUT_EXT_FIELD_BOUNDARY]['OUTPUT']],
-            'OUTPUT': parameters[self.OUTPUT_SECTIONS_LAYER]
-        }
-        outputs[self.OUTPUT_SECTIONS_LAYER] = processing.run('native:mergevectorlayers', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results[self.OUTPUT_SECTIONS_LAYER] = outputs[self.OUTPUT_SECTIONS_LAYER]['OUTPUT']
-
-        #-- call processing with child_algorithm = False to immediately get the result vector (key "OUTPUT" of resulting dictionary)
-        #sectionsVectorLayer = processing.run('native:mergevectorlayers', alg_params, context=context, feedback=feedback, is_child_algorithm=False)['OUTPUT']
-        
-        # Set Sections layer to result of processing
-        #results[self.OUTPUT_SECTIONS_LAYER] = sectionsVectorLayer.dataProvider().dataSourceUri() #sectionsVectorLayer.name()
-        
-        # -- Step 9: Export to Sections.txt
-        feedback.setCurrentStep(8)
-        if feedback.isCanceled():
+        # -- Step 3: Write cells to sections layer and Sections.txt
+        profiler.start('3 Write sections')
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT_SECTIONS_LAYER, context,
+                                               self.cellFields(), QgsWkbTypes.Polygon, wgs84)
+        mergeStrips = self.parameterAsBool(parameters, self.INPUT_MERGE_STRIPS, context)
+        if localGrid:
+            file = self.writeSectionsFile(parameters, context, self.localCellChunks(cells, frame, sink, mergeStrips),
+                                          len(cells), feedback, localCorners=True)
+        else:
+            transform = QgsCoordinateTransform(crs, wgs84, context.transformContext())
+            file = self.writeSectionsFile(parameters, context, self.rectCellChunks(cells, transform, sink, mergeStrips),
+                                          len(cells), feedback)
+        if file is None:
             return {}
+        profiler.count(inputFeatures=len(cells), outputFeatures=self.patchCount, outputVertices=self.count)
 
-        # Load Sections Vector Layer
-        layerpath = outputs[self.OUTPUT_SECTIONS_LAYER]['OUTPUT']
-        sectionsVectorLayer = QgsProcessingUtils.mapLayerFromString(layerpath, context)
+        if sink is not None:
+            results[self.OUTPUT_SECTIONS_LAYER] = dest_id
+        results[self.OUTPUT_SECTION_FILE] = file
+        return results
 
+    def streamSectionsFile(self, parameters, context, boundary, weeds, extent, engine, frame, transform, feedback,
+                           cacheFolder=None, tileSize=0):
+        """
+        Incremental Sections.txt with the cache in cacheFolder (see updateSections) or tiled
+        Sections.txt with tiles of tileSize meters (see generateTiledSections); the grid is in AOG
+        local coordinates if transform is None, otherwise transform converts the grid CRS to WGS84
+        """
+        results = {}
+        file = self.parameterAsFileOutput(parameters, self.OUTPUT_SECTION_FILE, context)
+        if file is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT_SECTION_FILE))
+        color: QColor = self.parameterAsColor(parameters, self.INPUT_COLOR, context)
+        wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT_SECTIONS_LAYER, context,
+                                               self.cellFields(), QgsWkbTypes.Polygon, wgs84)
+
+        fields = self.cellFields()
+        ids = [0]
+
+        def addCells(rects):
+            if transform is None:
+                geometries = self.localCellGeometries(rects, frame)
+            else:
+                geometries = self.cellGeometries(rects, transform)
+            for id, (rect, geometry) in enumerate(zip(rects.tolist(), geometries), ids[0]):
+                self.addCellFeature(sink, fields, id, rect, geometry)
+            ids[0] = ids[0] + len(rects)
+
+        def cellCorners(rects):
+            corners = b''.join(self.cellCornerBytes(geometry) for geometry in self.cellGeometries(rects, transform))
+            corners = np.frombuffer(corners, dtype='<f8').reshape(-1, 4, 2)
+            easting, northing = frame.toLocal(corners[:, :, 1], corners[:, :, 0])
+            return np.stack([easting, northing], axis=2)
+
+        if transform is None:
+            keyParts = (frame.latStart, frame.lonStart, 'AOG local')
+        else:
+            keyParts = (frame.latStart, frame.lonStart, transform.sourceCrs().toWkt())
+        grid_small = self.parameterAsDouble(parameters, self.INPUT_GRID_SMALL, context)
+        grid_large = self.parameterAsDouble(parameters, self.INPUT_GRID_LARGE, context)
+        mergeStrips = self.parameterAsBool(parameters, self.INPUT_MERGE_STRIPS, context)
+        try:
+            if cacheFolder:
+                stats = updateSections(boundary, weeds, file, cacheFolder, grid_small, grid_large, engine, mergeStrips,
+                               (color.red(), color.green(), color.blue()), keyParts=keyParts, extent=extent,
+                               cellCorners=rectCorners if transform is None else cellCorners,
+                               onCells=addCells if sink is not None else None, log=feedback.pushInfo)
+            else:
+                stats = generateTiledSections(boundary, weeds, file, grid_small, grid_large, engine, mergeStrips,
+                                      (color.red(), color.green(), color.blue()), tileSize, extent=extent,
+                                      cellCorners=rectCorners if transform is None else cellCorners,
+                                      keepPatches=self.existingPatches(parameters, context, feedback, keep=True),
+                                      onCells=addCells if sink is not None else None, log=feedback.pushInfo)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        self.patchCount = stats['patches']
+        self.count = stats['vertices']
+
+        if sink is not None:
+            results[self.OUTPUT_SECTIONS_LAYER] = dest_id
+        results[self.OUTPUT_SECTION_FILE] = file
+        return results
+
+    def weedRaster(self, parameters, context, layer, frame=None, gridCrs=None):
+        """
+        Returns a raster layer as WeedRaster for a grid in the AOG local coordinates of frame or in gridCrs
+        """
+        if layer.providerType() != 'gdal':
+            raise QgsProcessingException("Weed raster {} is not a file that GDAL can read".format(layer.name()))
+        try:
+            return WeedRaster(layer.source(), self.parameterAsDouble(parameters, self.INPUT_WEED_THRESHOLD, context),
+                              frame=frame, gridCrs=gridCrs)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+
+    def existingPatches(self, parameters, context, feedback, keep=False):
+        """
+        Reads the patches of the existing Sections.txt at the output path, or only if they are to
+        be kept with keep set; skipping applied cells keeps them as well, as the output replaces
+        the file. Returns None if there is no such file
+        """
+        if keep and not (self.parameterAsBool(parameters, self.INPUT_KEEP_EXISTING, context)
+                         or self.parameterAsBool(parameters, self.INPUT_SKIP_APPLIED, context)):
+            return None
+        file = self.parameterAsFileOutput(parameters, self.OUTPUT_SECTION_FILE, context)
+        if not file or not os.path.isfile(file):
+            return None
+        try:
+            patches = readSections(file)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        feedback.pushInfo("Existing {}: {} patches with {} vertices".format(file, patches.patchCount,
+                                                                           len(patches.vertices)))
+        return patches
+
+    def profileLayers(self, profiler, context, inputs=(), outputs=()):
+        """
+        Adds the features and vertices of the input and output layers (layers or layer ids)
+        to the current step of the profiler
+        """
+        if not profiler.enabled:
+            return
+        for prefix, layers in (('input', inputs), ('output', outputs)):
+            for layer in layers:
+                if isinstance(layer, str):
+                    layer = QgsProcessingUtils.mapLayerFromString(layer, context)
+                if layer is None:
+                    continue
+                vertices = 0
+                for feature in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+                    if feature.hasGeometry():
+                        vertices = vertices + feature.geometry().constGet().nCoordinates()
+                profiler.count(**{prefix + 'Features': layer.featureCount(), prefix + 'Vertices': vertices})
+
+    def reportProfile(self, profiler, parameters, context, feedback, results):
+        """
+        Pushes the profile of the steps to the log and writes it next to Sections.txt if requested
+        """
+        if not profiler.enabled or not results:
+            return
+        feedback.pushInfo("Profile of the steps:\n" + profiler.formatTable())
+        if self.parameterAsBool(parameters, self.INPUT_PROFILE_FILE, context):
+            path = os.path.splitext(results[self.OUTPUT_SECTION_FILE])[0] + '_profile.json'
+            profiler.save(path)
+            feedback.pushInfo("Profile written to {}".format(path))
+
+    def readPolygons(self, layer, crs, context):
+        """
+        Reads all polygons of a vector layer, transformed to crs, as lists of rings (see wkbPolygons)
+        """
+        transform = QgsCoordinateTransform(layer.crs(), crs, context.transformContext())
+        polygons = []
+        for feature in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if not feature.hasGeometry():
+                continue
+            geometry = QgsGeometry(feature.geometry())
+            geometry.transform(transform)
+            geometry.convertToStraightSegment()
+            polygons.extend(wkbPolygons(bytes(geometry.asWkb())))
+        return polygons
+
+    def cellFields(self):
+        """
+        Attributes of the cells in the sections layer, as created by native:creategrid
+        """
+        fields = QgsFields()
+        fields.append(QgsField('id', QVariant.LongLong))
+        for name in ('left', 'top', 'right', 'bottom'):
+            fields.append(QgsField(name, QVariant.Double))
+        return fields
+
+    def rectCellChunks(self, cells, transform, sink, mergeStrips):
+        """
+        Creates the cell polygons for cells given as array of left, top, right, bottom (or as
+        CellSet), adds them to sink (if any) and yields the WGS84 corners and strip starts
+        """
+        fields = self.cellFields()
+        for start in range(0, len(cells), self.EXPORT_CHUNK_SIZE):
+            if isinstance(cells, CellSet):
+                rects = cells.rects(start, start + self.EXPORT_CHUNK_SIZE)
+            else:
+                rects = cells[start:start + self.EXPORT_CHUNK_SIZE]
+            chunk = []
+            for id, (rect, geometry) in enumerate(zip(rects.tolist(), self.cellGeometries(rects, transform)), start):
+                if sink is not None:
+                    self.addCellFeature(sink, fields, id, rect, geometry)
+                chunk.append(self.cellCornerBytes(geometry))
+            yield (np.frombuffer(b''.join(chunk), dtype='<f8').reshape(-1, 4, 2),
+                   stripStarts(rects, mergeStrips))
+
+    def localCellChunks(self, cells, frame, sink, mergeStrips):
+        """
+        Like rectCellChunks for cells in AOG local coordinates; yields the local corners,
+        WGS84 is only calculated for the polygons of the sections layer
+        """
+        fields = self.cellFields()
+        for start in range(0, len(cells), self.EXPORT_CHUNK_SIZE):
+            rects = cells[start:start + self.EXPORT_CHUNK_SIZE]
+            corners = rectCorners(rects)
+            if sink is not None:
+                for id, (rect, geometry) in enumerate(zip(rects.tolist(), self.localCellGeometries(rects, frame)), start):
+                    self.addCellFeature(sink, fields, id, rect, geometry)
+            yield corners, stripStarts(rects, mergeStrips)
+
+    def cellGeometries(self, rects, transform):
+        """
+        Returns the WGS84 polygons of cells given as left, top, right, bottom in the grid CRS
+        """
+        geometries = []
+        for left, top, right, bottom in rects.tolist():
+            # same vertex order as native:creategrid
+            geometry = QgsGeometry.fromPolygonXY([[QgsPointXY(left, top), QgsPointXY(right, top),
+                                                   QgsPointXY(right, bottom), QgsPointXY(left, bottom),
+                                                   QgsPointXY(left, top)]])
+            geometry.transform(transform)
+            geometries.append(geometry)
+        return geometries
+
+    def localCellGeometries(self, rects, frame):
+        """
+        Returns the WGS84 polygons of cells in AOG local coordinates
+        """
+        corners = rectCorners(rects)
+        lat, lon = frame.toWGS84(corners[:, :, 0], corners[:, :, 1])
+        return [QgsGeometry.fromPolygonXY([[QgsPointXY(x, y) for x, y in zip(lons + lons[:1], lats + lats[:1])]])
+                for lons, lats in zip(lon.tolist(), lat.tolist())]
+
+    def addCellFeature(self, sink, fields, id, rect, geometry):
+        feature = QgsFeature(fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes([id] + list(rect))
+        sink.addFeature(feature, QgsFeatureSink.FastInsert)
+
+    def fieldFrame(self, parameters, context, feedback):
+        """
+        Reads the StartFix from the AOG fields file and returns the AOG local frame
+        """
         # Retrieve AGO fields file
         fields = self.parameterAsFile(
             parameters, self.INPUT_FIELDS_FILE, context)
@@ -318,6 +861,20 @@ class AgSectionFileCreator(QgsProcessingAlgorithm):
             raise QgsProcessingException(self.invalidSourceError(
                 parameters, self.INPUT_FIELDS_FILE))
 
+        try:
+            latStart, lonStart = readStartFix(fields)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        feedback.pushInfo(f"LatStart is {latStart} and LonStart is {lonStart}")
+        return LocalFrame(latStart, lonStart)
+
+    def writeSectionsFile(self, parameters, context, cellChunks, cellCount, feedback, localCorners=False):
+        """
+        Writes the cells to the AOG Sections.txt file; cellChunks yields arrays of WGS84
+        cell corners and strip starts as returned by rectCellChunks, or corners in
+        AOG local coordinates if localCorners is set.
+        Returns the path of the written file or None if the algorithm was canceled
+        """
         file = self.parameterAsFileOutput(
             parameters, self.OUTPUT_SECTION_FILE, context)
 
@@ -337,147 +894,52 @@ class AgSectionFileCreator(QgsProcessingAlgorithm):
 
         # Compute the number of steps to display within the progress bar and
         # get features fromsource 
-        total = 100.0 / sectionsVectorLayer.featureCount() if sectionsVectorLayer.featureCount() else 0       
-
-        # Init AGO Logic
-        self.setLatLonStart(fields, feedback)
-        self.setLocalMetersPerDegree(self.latStart)
+        total = 100.0 / cellCount if cellCount else 0
 
-        '''
-        feedback.pushInfo("Reading Geometries...")
-        vertexList = []
-        for current, feature in enumerate(features):
-            # Stop the algorithm if cancel button has been clicked
-            if feedback.isCanceled():
-                #break
-                exit()
-
-            # Get feature geometry
-            if feature.hasGeometry():
-                # TODO: Fehler wenn kein Qudarat/Rechteck!
-                vertices = list(feature.geometry().vertices())
-                vertexList.append(self.convertWGS84ToLocal(vertices[0].y(), vertices[0].x()))
-                vertexList.append(self.convertWGS84ToLocal(vertices[3].y(), vertices[3].x()))
-                vertexList.append(self.convertWGS84ToLocal(vertices[1].y(), vertices[1].x()))
-                vertexList.append(self.convertWGS84ToLocal(vertices[2].y(), vertices[2].x()))
-            
-        # Remove duplicate vertices and split to patches
-        # -> when printing two adjacent quadrats, the 2nd vertex of the first is identical to the 1st vertex of the second
-        # -> and the 4th vertex of the first is identical to the 3rd of the second
-        # 1--2 1--2 1--2
-        # |  | |  | |  |
-        # 3--4 3--4 3--4
-        # => we want to remove the duplicates
-        cleanVertexList = []
-        patchList = []
-        for i, vertex in enumerate(vertexList):
-            if i < 4: # we take the first 4
-                cleanVertexList.append(vertex)
-            else: # checks start with the 5th vertex
-                if i % 2: # we check only uneven indexes (5th, 7th, etc.)
-                    if not vertex == vertexList[i-3]:
-                        # not identical: store this as new patch
-                        feedback.pushInfo(str(cleanVertexList))
-                        feedback.pushInfo("----------------------")
-                        patchList.append(cleanVertexList)
-                        # Clear list
-                        cleanVertexList.clear()
-                        cleanVertexList.append(vertex)
-                else: # even index, we use these
-                    cleanVertexList.append(vertex)
-        
-
-        feedback.pushInfo("Writing Sections file...")
-        with open(file, "w") as output_file:
-            for patch in patchList:
-                output_file.write(str(len(patch))+"\n")
-                output_file.write('27,151,160' +"\n")
-                for p in patch:
-                    output_file.write(p +"\n")
+        frame = None if localCorners else self.fieldFrame(parameters, context, feedback)
 
-        '''
+        patches = self.existingPatches(parameters, context, feedback, keep=True)
 
         feedback.pushInfo("Writing Sections file...")
-        # get features to process from sections vector layer
-        features = sectionsVectorLayer.getFeatures()
-        with open(file, "w") as output_file:
-            for current, feature in enumerate(features):
+        current = 0
+        with SectionsWriter(file, (color.red(), color.green(), color.blue())) as writer:
+            if patches is not None:
+                writer.writePatches(patches)
+            for corners, starts in cellChunks:
                 # Stop the algorithm if cancel button has been clicked
                 if feedback.isCanceled():
-                    # break
-                    exit()
-
-                # Get feature geometry
-                if feature.hasGeometry():
-
-                    verticeList = list(feature.geometry().vertices())
-                    output_file.write('5' + "\n")
-                    output_file.write('{r},{g},{b}'.format(r=color.red(), g=color.green(), b=color.blue()) + "\n")
-                    #output_file.write('27,151,160' + "\n")
-
-                    s = self.convertWGS84ToLocal(
-                        verticeList[0].y(), verticeList[0].x())
-                    output_file.write(s + "\n")
-                    self.count = self.count + 1
-
-                    s = self.convertWGS84ToLocal(
-                        verticeList[3].y(), verticeList[3].x())
-                    output_file.write(s + "\n")
-                    self.count = self.count + 1
-
-                    s = self.convertWGS84ToLocal(
-                        verticeList[1].y(), verticeList[1].x())
-                    output_file.write(s + "\n")
-                    self.count = self.count + 1
+                    # keeps the existing Sections.txt instead of replacing it by the part written so far
+                    writer.abort()
+                    return None
 
-                    s = self.convertWGS84ToLocal(
-                        verticeList[2].y(), verticeList[2].x())
-                    output_file.write(s + "\n")
-                    self.count = self.count + 1
+                if not localCorners:
+                    easting, northing = frame.toLocal(corners[:, :, 1], corners[:, :, 0])
+                    corners = np.stack([easting, northing], axis=2)
+                writer.writeCells(corners, starts)
+                self.count = writer.vertexCount
+                self.patchCount = writer.patchCount
 
                 # Update the progress bar
+                current = current + len(corners)
                 feedback.setProgress(int(current * total))
 
-        # add Section file output to results
-        results[self.OUTPUT_SECTION_FILE] = file
-        # return results
-        return results
+        return file
+
+    def cellCornerBytes(self, geometry) -> bytes:
+        """
+        Returns x / y of the first four vertices of a cell polygon as little endian doubles;
+        the coordinates are sliced directly from the WKB, which avoids creating a QgsPoint per vertex
+        """
+        wkb = bytes(geometry.asWkb())
+        layout = wkbRingLayout(wkb)
+        if layout is not None:
+            offset, dimension, littleEndian = layout
+            if dimension == 2 and littleEndian:
+                return wkb[offset:offset + 64]
+            coords = np.frombuffer(wkb, dtype='<f8' if littleEndian else '>f8', count=4 * dimension, offset=offset)
+            return coords.reshape(4, dimension)[:, :2].astype('<f8').tobytes()
+
+        # curved or otherwise unusual geometry, use the generic vertex iterator
+        vertices = list(geometry.vertices())
+        return struct.pack('<8d', *(c for v in vertices[:4] for c in (v.x(), v.y())))
 
-    '''
-    Opens AOG fields file and reads Start Lat/Lon
-    '''
-
-    def setLatLonStart(self, pathToFieldsFile, feedback):
-        # read file
-        with open(pathToFieldsFile, "r") as field:
-            lines = field.readlines()
-        # Search StartFix line
-        i = lines.index("StartFix\n")
-        # get value
-        startfix = lines[i+1]
-        feedback.pushInfo(f"StartFix from Fields:{startfix}")
-        # set latStart and lonStart
-        latlon = startfix.split(",")
-        self.latStart = float(latlon[0])
-        self.lonStart = float(latlon[1])
-        feedback.pushInfo(
-            f"LatStart is {self.latStart} and LonStart is {self.lonStart}")
-
-    def setLocalMetersPerDegree(self, latStart):
-        self.mPerDegreeLat = 111132.92 - 559.82 * cos(2.0 * latStart * 0.01745329251994329576923690766743) + 1.175 * cos(
-            4.0 * latStart * 0.01745329251994329576923690766743) - 0.0023 * cos(6.0 * latStart * 0.01745329251994329576923690766743)
-
-        self.mPerDegreeLon = 111412.84 * cos(latStart * 0.01745329251994329576923690766743) - 93.5 * cos(
-            3.0 * latStart * 0.01745329251994329576923690766743) + 0.118 * cos(5.0 * latStart * 0.01745329251994329576923690766743)
-
-    def convertWGS84ToLocal(self, Lat, Lon) -> str:
-
-        self.mPerDegreeLon = 111412.84 * \
-            cos(Lat * 0.01745329251994329576923690766743) - 93.5 * \
-            cos(3.0 * Lat * 0.01745329251994329576923690766743)
-        + 0.118 * cos(5.0 * Lat * 0.01745329251994329576923690766743)
-
-        Northing = (Lat - self.latStart) * self.mPerDegreeLat
-        Easting = (Lon - self.lonStart) * self.mPerDegreeLon
-
-        return(str(round(Easting, 3)) + "," + str(round(Northing, 3)) + ",0")
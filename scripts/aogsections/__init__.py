@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Core library of the section file creator for AGOpenGPS; needs only Python and NumPy,
+   so it can run without QGIS. The QGIS processing script AOG_Conversion_v2.py is a wrapper around it.
+"""
+
+from .batch import runBatch
+from .cellset import CellSet
+from .fieldfiles import readKmlPolygons, readPolygons, readStartFix
+from .geometry import CellGrid, wkbPolygons
+from .localframe import LocalFrame
+from .pipeline import ENGINE_QUADTREE, ENGINE_RASTER_MASK, FieldGrid, generateSections, sectionCells, updateSections
+from .sections import DEFAULT_COLOR, SectionPatches, SectionsWriter, readSections
+from .tiling import generateTiledSections
+from .verify import verifySections
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Batch generation of Sections.txt for all fields of an AgOpenGPS Fields folder,
+   with the fields distributed over worker processes
+"""
+
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .fieldfiles import POLYGON_EXTENSIONS, readPolygons
+from .localframe import LocalFrame
+from .pipeline import ENGINE_RASTER_MASK, generateSections
+from .sections import DEFAULT_COLOR
+from .weedraster import DEFAULT_THRESHOLD, RASTER_EXTENSIONS, readWeeds
+
+
+def findFields(fieldsRoot):
+    """
+    Returns the names of the AOG field folders (with Field.txt and Field.kml) in fieldsRoot
+    """
+    return sorted(name for name in os.listdir(fieldsRoot)
+                  if os.path.isfile(os.path.join(fieldsRoot, name, 'Field.txt'))
+                  and os.path.isfile(os.path.join(fieldsRoot, name, 'Field.kml')))
+
+
+def readWeedMapping(path):
+    """
+    Reads a CSV file with the columns field name and weed file; weed files are relative
+    to the folder of the mapping file. Empty lines and lines starting with # are skipped
+    """
+    mapping = {}
+    with open(path, newline='') as file:
+        for row in csv.reader(file):
+            if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+                continue
+            if len(row) < 2:
+                raise ValueError("{}: expected field name and weed file in line {}".format(path, ','.join(row)))
+            mapping[row[0].strip()] = os.path.join(os.path.dirname(os.path.abspath(path)), row[1].strip())
+    return mapping
+
+
+def findWeedFile(field, weedsDir=None, mapping=None):
+    """
+    Returns the weed file of a field: from the mapping, or the polygon or raster file in weedsDir
+    that is named like the field (case insensitive); None if there is none
+    """
+    if mapping and field in mapping:
+        return mapping[field]
+    if weedsDir is None:
+        return None
+    for name in sorted(os.listdir(weedsDir)):
+        stem, extension = os.path.splitext(name)
+        if stem.lower() == field.lower() and extension.lower() in POLYGON_EXTENSIONS + RASTER_EXTENSIONS:
+            return os.path.join(weedsDir, name)
+    return None
+
+
+def generateField(job):
+    """
+    Generates Sections.txt for one field of a batch; runs in a worker process and returns
+    a result dict instead of raising, so one broken field does not stop the batch
+    """
+    start = time.perf_counter()
+    result = {'field': job['field'], 'ok': False, 'seconds': 0.0}
+    try:
+        fieldDir = job['fieldDir']
+        frame = LocalFrame.fromFieldFile(os.path.join(fieldDir, 'Field.txt'))
+        stats = generateSections(readPolygons(os.path.join(fieldDir, 'Field.kml')),
+                                 readWeeds(job['weeds'], frame, job['weedThreshold']), frame,
+                                 os.path.join(fieldDir, job['outputName']), **job['options'])
+        result.update(stats, ok=True)
+    except Exception as e:
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def runBatch(fieldsRoot, weedsDir=None, mapping=None, workers=None, outputName='Sections.txt', gridSmall=1.0,
+             gridLarge=10.0, engine=ENGINE_RASTER_MASK, mergeStrips=True, color=DEFAULT_COLOR, cacheDir=None,
+             tileSize=None, weedThreshold=DEFAULT_THRESHOLD, log=print):
+    """
+    Generates Sections.txt (outputName) in every field folder of fieldsRoot that has a weed file
+    (see findWeedFile), with up to workers processes (default: number of CPUs); pixels of weed
+    rasters at or above weedThreshold are weeds.
+    Returns the result dicts (field, ok, seconds and patches / vertices or error) in field order
+    """
+    options = {'gridSmall': gridSmall, 'gridLarge': gridLarge, 'engine': engine, 'mergeStrips': mergeStrips,
+               'color': color, 'cacheDir': cacheDir, 'tileSize': tileSize}
+    results = {}
+    jobs = []
+    for field in findFields(fieldsRoot):
+        weeds = findWeedFile(field, weedsDir, mapping)
+        if weeds is None:
+            results[field] = {'field': field, 'ok': False, 'seconds': 0.0, 'error': 'no weed file'}
+            continue
+        jobs.append({'field': field, 'fieldDir': os.path.join(fieldsRoot, field), 'weeds': weeds,
+                     'outputName': outputName, 'weedThreshold': weedThreshold, 'options': options})
+    log("{} fields in {}, {} with weed files".format(len(results) + len(jobs), fieldsRoot, len(jobs)))
+    start = time.perf_counter()
+
+    if workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            results[job['field']] = generateField(job)
+            logResult(results[job['field']], log)
+    elif jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for future in as_completed([executor.submit(generateField, job) for job in jobs]):
+                result = future.result()
+                results[result['field']] = result
+                logResult(result, log)
+    log("Batch finished in {:.2f} s".format(time.perf_counter() - start))
+    return [results[field] for field in sorted(results)]
+
+
+def logResult(result, log):
+    if result['ok']:
+        log("{}: {} patches in {:.2f} s".format(result['field'], result['patches'], result['seconds']))
+    else:
+        log("{}: failed, {}".format(result['field'], result['error']))
+
+
+def formatSummary(results):
+    """
+    Returns the per field summary of a batch as text table
+    """
+    width = max([len('Field')] + [len(result['field']) for result in results])
+    lines = ["{:<{}}  {:<7}  {:>9}  {:>9}  {}".format('Field', width, 'Status', 'Seconds', 'Patches', 'Error')]
+    for result in results:
+        lines.append("{:<{}}  {:<7}  {:>9.2f}  {:>9}  {}".format(
+            result['field'], width, 'ok' if result['ok'] else 'failed', result['seconds'],
+            result.get('patches', ''), result.get('error', '')).rstrip())
+    failed = sum(1 for result in results if not result['ok'])
+    lines.append("{} fields, {} ok, {} failed, {:.2f} s processing time".format(
+        len(results), len(results) - failed, failed, sum(result['seconds'] for result in results)))
+    return '\n'.join(lines)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Benchmark of the section calculation: synthetic fields and weeds of different sizes and
+   the bundled QGIS example, timed per stage with peak memory and output size; results are
+   saved as JSON and can be compared with a previous run to find regressions
+"""
+
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from .fieldfiles import readPolygons
+from .localframe import LocalFrame
+from .pipeline import ENGINE_RASTER_MASK, FieldGrid, writeCells
+from .sections import DEFAULT_COLOR, SectionsWriter
+
+RESULTS_VERSION = 1
+
+# field sizes in ha, weed polygon counts and grid sizes (small, large) of the presets
+PRESETS = {
+    'quick': {'areas': (1, 10), 'weeds': (10, 1000), 'grids': ((1.0, 10.0),)},
+    'full': {'areas': (1, 10, 100, 500), 'weeds': (10, 100, 1000, 10000, 30000),
+             'grids': ((1.0, 10.0), (0.5, 5.0))},
+}
+
+EXAMPLE_FOLDER = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'qgis',
+                                               'example'))
+
+
+def syntheticField(area, weedCount, seed=0):
+    """
+    Returns a field boundary of area ha (an irregular, roughly square polygon with 200 vertices)
+    and weedCount weed polygons (octagons of 0.3 to 3 m radius) in local meters; the same
+    arguments always give the same polygons
+    """
+    rng = np.random.default_rng(seed)
+    radius = np.sqrt(area * 10000.0 / np.pi)
+    angles = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+    wobble = 1 + 0.08 * np.sin(5 * angles) + 0.04 * np.sin(11 * angles + 1.0)
+    ring = np.column_stack([np.cos(angles), np.sin(angles)]) * radius * wobble[:, None]
+    # scale to the exact area (shoelace)
+    ring = ring * np.sqrt(area * 10000.0 / (0.5 * abs(np.dot(ring[:, 0], np.roll(ring[:, 1], 1))
+                                                      - np.dot(ring[:, 1], np.roll(ring[:, 0], 1)))))
+    boundary = [[np.vstack([ring, ring[:1]])]]
+
+    corners = np.linspace(0, 2 * np.pi, 9)
+    octagon = np.column_stack([np.cos(corners), np.sin(corners)])
+    centers = rng.uniform(-radius, radius, (weedCount, 2))
+    sizes = rng.uniform(0.3, 3.0, weedCount)
+    weeds = [[octagon * size + center] for center, size in zip(centers, sizes)]
+    return boundary, weeds
+
+
+def benchmarkCases(preset='quick', engines=(ENGINE_RASTER_MASK,), example=EXAMPLE_FOLDER):
+    """
+    Returns the cases of a preset as dicts with id and parameters; the QGIS example is
+    included if its folder exists
+    """
+    settings = PRESETS[preset]
+    cases = []
+    for engine in engines:
+        for gridSmall, gridLarge in settings['grids']:
+            for area in settings['areas']:
+                for weedCount in settings['weeds']:
+                    cases.append({'id': 'synthetic-{}ha-{}weeds-{}x{}-{}'.format(
+                        area, weedCount, gridSmall, gridLarge, engine), 'area': area, 'weedCount': weedCount,
+                        'gridSmall': gridSmall, 'gridLarge': gridLarge, 'engine': engine})
+            if example and os.path.isfile(os.path.join(example, 'Field.txt')):
+                cases.append({'id': 'example-{}x{}-{}'.format(gridSmall, gridLarge, engine), 'example': example,
+                              'gridSmall': gridSmall, 'gridLarge': gridLarge, 'engine': engine})
+    return cases
+
+
+def _caseStages(case, path):
+    """
+    Returns the stages of a case as list of (name, function); the functions share their state
+    """
+    state = {}
+
+    def read():
+        if 'example' in case:
+            frame = LocalFrame.fromFieldFile(os.path.join(case['example'], 'Field.txt'))
+            state['boundary'] = frame.polygonsToLocal(readPolygons(os.path.join(case['example'], 'Field.kml')))
+            state['weeds'] = frame.polygonsToLocal(readPolygons(os.path.join(case['example'], 'weeds.shp')))
+        else:
+            state['boundary'], state['weeds'] = syntheticField(case['area'], case['weedCount'])
+
+    def boundary():
+        gridLarge = case['gridLarge'] if case['engine'] == ENGINE_RASTER_MASK else None
+        state['fieldGrid'] = FieldGrid.fromBoundary(state['boundary'], case['gridSmall'], gridLarge, case['engine'])
+
+    def weeds():
+        state['weedy'] = state['fieldGrid'].weedMask(state['weeds'])
+
+    def cells():
+        state['cells'] = state['fieldGrid'].cells(state['weedy'])
+
+    def export():
+        with SectionsWriter(path, DEFAULT_COLOR) as writer:
+            writeCells(writer, state['cells'], True)
+        state['output'] = {'cells': len(state['cells']), 'patches': writer.patchCount,
+                           'vertices': writer.vertexCount, 'bytes': os.path.getsize(path)}
+
+    return [('read', read), ('boundary', boundary), ('weeds', weeds), ('cells', cells), ('export', export)], state
+
+
+def runCase(case, repeat=3):
+    """
+    Runs a case once with tracemalloc for the peak memory per stage and repeat times without
+    it for the time per stage (the fastest run counts, tracemalloc would slow down the stages).
+    Returns the result dict
+    """
+    result = dict(case)
+    stageResults = {}
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'Sections.txt')
+        stages, state = _caseStages(case, path)
+        tracemalloc.start()
+        for name, stage in stages:
+            tracemalloc.reset_peak()
+            stage()
+            stageResults[name] = {'peakMB': tracemalloc.get_traced_memory()[1] / 2 ** 20}
+        tracemalloc.stop()
+        result.update(state['output'])
+
+        for _ in range(max(repeat, 1)):
+            stages, state = _caseStages(case, path)
+            for name, stage in stages:
+                start = time.perf_counter()
+                stage()
+                seconds = time.perf_counter() - start
+                stageResults[name]['seconds'] = min(stageResults[name].get('seconds', seconds), seconds)
+    result['stages'] = stageResults
+    result['seconds'] = sum(stage['seconds'] for stage in stageResults.values())
+    result['peakMB'] = max(stage['peakMB'] for stage in stageResults.values())
+    return result
+
+
+def runBenchmark(cases, repeat=3, log=print):
+    """
+    Runs all cases and returns the results with some information about the machine
+    """
+    results = []
+    for case in cases:
+        result = runCase(case, repeat)
+        log("{}: {:.3f} s, {:.1f} MB, {} patches, {} vertices".format(
+            result['id'], result['seconds'], result['peakMB'], result['patches'], result['vertices']))
+        results.append(result)
+    return {'version': RESULTS_VERSION, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.platform(),
+            'processor': platform.processor(), 'cases': results}
+
+
+def saveResults(results, path):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=1)
+
+
+def loadResults(path):
+    with open(path) as file:
+        results = json.load(file)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError("{} is not a benchmark result of version {}".format(path, RESULTS_VERSION))
+    return results
+
+
+def compareResults(previous, current, tolerance=0.2, minSeconds=0.05):
+    """
+    Compares the cases of two benchmark results. A case is a regression if its time or peak
+    memory grew by more than tolerance (relative) - for times also by more than minSeconds,
+    to ignore the noise of very short cases - or if its output changed.
+    Returns a list of (case id, message) and the list of regressions
+    """
+    before = {case['id']: case for case in previous['cases']}
+    lines = []
+    regressions = []
+    for case in current['cases']:
+        old = before.get(case['id'])
+        if old is None:
+            lines.append((case['id'], 'new case'))
+            continue
+        problems = []
+        if case['seconds'] > old['seconds'] * (1 + tolerance) and case['seconds'] - old['seconds'] > minSeconds:
+            problems.append('time')
+        if case['peakMB'] > old['peakMB'] * (1 + tolerance):
+            problems.append('memory')
+        if (case['patches'], case['vertices']) != (old['patches'], old['vertices']):
+            problems.append('output')
+        message = "time {:.3f} -> {:.3f} s ({:+.0%}), memory {:.1f} -> {:.1f} MB, patches {} -> {}".format(
+            old['seconds'], case['seconds'], case['seconds'] / old['seconds'] - 1 if old['seconds'] else 0,
+            old['peakMB'], case['peakMB'], old['patches'], case['patches'])
+        if problems:
+            message = "REGRESSION ({}): {}".format(', '.join(problems), message)
+            regressions.append(case['id'])
+        lines.append((case['id'], message))
+    return lines, regressions
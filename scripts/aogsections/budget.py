@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Grid sizes for a patch budget: estimates cells, patches and size of Sections.txt for
+   candidate grid sizes from area and perimeter of field and weeds only (no grid is created),
+   and picks the finest small grid whose estimate stays within a maximum patch count or file size
+"""
+
+import math
+
+import numpy as np
+
+from .geometry import quadtreeLevels
+from .pipeline import ENGINE_QUADTREE, ENGINE_RASTER_MASK, checkGridSizes, polygonBounds
+from .sections import DEFAULT_COLOR, MAX_STRIP_CELLS, formatColor
+
+# candidate sizes of the small grid in meters and large grid sizes as multiples of it
+SMALL_SIZES = (0.1, 0.2, 0.25, 0.5, 1.0, 2.0, 2.5, 5.0, 10.0)
+LARGE_FACTORS = (2, 4, 5, 8, 10, 16, 20, 25, 32, 40, 50)
+
+
+def _ringArea(ring):
+    return 0.5 * abs(np.dot(ring[:-1, 0], ring[1:, 1]) - np.dot(ring[1:, 0], ring[:-1, 1]))
+
+
+def _ringExtents(ring):
+    """
+    Returns the sums of |dx| and |dy| over the edges of a ring
+    """
+    dx, dy = np.abs(np.diff(ring, axis=0)).sum(axis=0).tolist()
+    return dx, dy
+
+
+def _insideField(points, boundary):
+    """
+    Even-odd test of points against all rings of the boundary polygons
+    """
+    inside = np.zeros(len(points), dtype=bool)
+    for rings in boundary:
+        for ring in rings:
+            x0, y0, x1, y1 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+            for start in range(0, len(points), 4096):
+                px = points[start:start + 4096, 0, None]
+                py = points[start:start + 4096, 1, None]
+                crosses = (y0 > py) != (y1 > py)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+                inside[start:start + 4096] ^= (crosses & (px < x)).sum(axis=1) % 2 == 1
+    return inside
+
+
+def fieldMeasures(boundary, weeds):
+    """
+    Returns area and the sums of |dx| and |dy| along the outline of the field and of every weed
+    polygon within it (polygons in meters, e.g. AOG local coordinates); weeds count as within
+    the field if their first vertex is
+    """
+    area = sum(_ringArea(rings[0]) - sum(_ringArea(hole) for hole in rings[1:]) for rings in boundary)
+    dx, dy = np.array([_ringExtents(ring) for rings in boundary for ring in rings]).sum(axis=0).tolist()
+    weeds = [rings for rings in weeds if rings and len(rings[0]) >= 4]
+    if weeds:
+        weeds = [rings for rings, inside in zip(weeds, _insideField(np.array([rings[0][0] for rings in weeds]),
+                                                                     boundary)) if inside]
+    xmin, ymin, xmax, ymax = polygonBounds(boundary)
+    weedExtents = np.array([np.sum([_ringExtents(ring) for ring in rings], axis=0) for rings in weeds]).reshape(-1, 2)
+    return {'area': area, 'dx': dx, 'dy': dy, 'width': xmax - xmin, 'height': ymax - ymin,
+            'weedAreas': np.array([_ringArea(rings[0]) - sum(_ringArea(hole) for hole in rings[1:])
+                                   for rings in weeds]),
+            'weedDx': weedExtents[:, 0], 'weedDy': weedExtents[:, 1],
+            # typical length of a vertex line in Sections.txt
+            'vertexBytes': float(np.mean([len('{},{},0\n'.format(round(x, 3), round(y, 3)))
+                                          for x, y in np.concatenate(boundary[0])[::7].tolist()]))}
+
+
+def _cellCounts(measures, size):
+    """
+    Expected numbers of cells of a size: on the field boundary, touching weeds and within the
+    field, and the share of the weed cells left after overlaps. A curve touches
+    (sum |dx| + sum |dy|) / size cells of a randomly placed grid, a convex polygon of area a
+    touches a / size^2 + (sum |dx| + sum |dy|) / (2 size) + 1 cells; overlaps of the weeds
+    are accounted for as if they were placed at random
+    """
+    boundary = (measures['dx'] + measures['dy']) / size
+    inside = max(measures['area'] / size ** 2 - boundary / 2, 0.0)
+    weeds = float(np.sum(measures['weedAreas'] / size ** 2 + (measures['weedDx'] + measures['weedDy']) / (2 * size)
+                         + 1))
+    if inside <= 0 or weeds <= 0:
+        return boundary, 0.0, inside, 1.0
+    covered = inside * -math.expm1(-weeds / inside)
+    return boundary, covered, inside, covered / weeds
+
+
+def _runs(rise, size, cells):
+    """
+    Expected number of row runs of a cell region whose outline has the vertical extent rise
+    on its left sides (half of the sum of |dy|); every run starts at such a side
+    """
+    return min(rise / size, cells) if cells > 0 else 0.0
+
+
+def _patches(cells, runs, mergeStrips):
+    if not mergeStrips:
+        return cells
+    if runs <= 0:
+        return 0.0
+    # runs longer than MAX_STRIP_CELLS are split; with geometric distributed run lengths,
+    # a run is longer than k MAX_STRIP_CELLS cells with probability q^(k MAX_STRIP_CELLS)
+    longer = (1 - runs / max(cells, runs)) ** MAX_STRIP_CELLS
+    return runs * (1 + longer / (1 - longer)) if longer < 1 else cells / MAX_STRIP_CELLS
+
+
+def estimateCounts(measures, gridSmall, gridLarge=None, engine=ENGINE_RASTER_MASK, mergeStrips=True,
+                   color=DEFAULT_COLOR):
+    """
+    Estimates cells, patches, vertices and bytes of Sections.txt for the grid sizes from
+    fieldMeasures
+    """
+    rise = measures['dy'] / 2
+    weedRise = float(measures['weedDy'].sum()) / 2
+    weedCount = len(measures['weedDy'])
+    edge, weedy, inside, overlap = _cellCounts(measures, gridSmall)
+    if engine == ENGINE_QUADTREE:
+        top = quadtreeLevels((max(int(measures['height'] / gridSmall), 1), max(int(measures['width'] / gridSmall), 1)))
+        sizes = [gridSmall * 2 ** level for level in range(top + 1)]
+        counts = [_cellCounts(measures, size) for size in sizes]
+        topSize = sizes[-1]
+        cells = max(counts[-1][2] - counts[-1][1], 0.0)
+        # weeds close to each other share their holes in the coarser cells
+        runs = _runs(min(rise + (weedRise + weedCount * topSize) * counts[-1][3], cells * topSize), topSize, cells)
+        patches = _patches(cells, runs, mergeStrips)
+        for level in range(top - 1, -1, -1):
+            (parentEdge, parentWeedy, _, _), (levelEdge, levelWeedy, _, levelOverlap) = counts[level + 1], counts[level]
+            # free children of parents on the field boundary or touching weeds; of the
+            # children of boundary parents that do not touch the boundary, half are outside
+            children = 4 * (parentEdge + parentWeedy) - levelEdge - levelWeedy - (4 * parentEdge - levelEdge) / 2
+            levelCells = max(children, 0.0) + (levelEdge if level == 0 else 0.0)
+            # cells of a level form a band around the obstacles
+            runs = _runs(2 * (rise + weedRise * levelOverlap), sizes[level], levelCells)
+            cells = cells + levelCells
+            patches = patches + _patches(levelCells, runs, mergeStrips)
+    else:
+        factor = int(round(gridLarge / gridSmall))
+        _, largeWeedy, largeInside, largeOverlap = _cellCounts(measures, gridLarge)
+        large = max(largeInside - largeWeedy, 0.0)
+        small = max(inside - weedy - large * factor ** 2, 0.0)
+        # outline of the large cells: field boundary and the holes around the weeds, which
+        # weeds close to each other share
+        largeRise = min(rise + (weedRise + weedCount * gridLarge) * largeOverlap, large * gridLarge) \
+            if large > 0 else 0.0
+        largeRuns = _runs(largeRise, gridLarge, large)
+        smallRuns = _runs(rise + largeRise + weedRise * overlap, gridSmall, small + edge)
+        cells = large + small + edge
+        patches = _patches(large, largeRuns, mergeStrips) + _patches(small + edge, smallRuns, mergeStrips)
+    vertices = 2 * cells + 2 * patches
+    headerBytes = len(formatColor(color)) + 3
+    return {'cells': int(round(cells)), 'patches': int(round(patches)), 'vertices': int(round(vertices)),
+            'bytes': int(round(vertices * measures['vertexBytes'] + patches * headerBytes))}
+
+
+def candidateGrids(maxSmall, engine=ENGINE_RASTER_MASK, measures=None):
+    """
+    Returns the candidate (small, large) grid sizes with a small size up to maxSmall; large
+    grids do not exceed the field extent of measures. The quadtree engine has no large grid
+    """
+    smalls = [size for size in SMALL_SIZES if size <= maxSmall + 1e-9] or [maxSmall]
+    if engine == ENGINE_QUADTREE:
+        return [(small, None) for small in smalls]
+    limit = min(measures['width'], measures['height']) if measures is not None else float('inf')
+    candidates = [(small, round(small * factor, 9)) for small in smalls for factor in LARGE_FACTORS
+                  if small * factor <= max(limit, small * LARGE_FACTORS[0])]
+    # only pairs the pipeline accepts
+    for small, large in candidates:
+        checkGridSizes(small, large)
+    return candidates
+
+
+def chooseGridSizes(measures, maxPatches=None, maxBytes=None, maxSmall=1.0, engine=ENGINE_RASTER_MASK,
+                    mergeStrips=True, color=DEFAULT_COLOR):
+    """
+    Estimates all candidate grids and picks the finest small grid (the best accuracy) with
+    an estimate within maxPatches and maxBytes, and for it the large grid with the fewest
+    patches. If no candidate fits, the one with the fewest patches is picked.
+    Returns the picked estimate and all estimates, each a dict with gridSmall, gridLarge,
+    the estimated counts and withinBudget
+    """
+    if maxPatches is None and maxBytes is None:
+        raise ValueError("A maximum patch count or file size is needed")
+    estimates = []
+    for gridSmall, gridLarge in candidateGrids(maxSmall, engine, measures):
+        estimate = estimateCounts(measures, gridSmall, gridLarge, engine, mergeStrips, color)
+        estimate.update(gridSmall=gridSmall, gridLarge=gridLarge, withinBudget=(
+            (maxPatches is None or estimate['patches'] <= maxPatches)
+            and (maxBytes is None or estimate['bytes'] <= maxBytes)))
+        estimates.append(estimate)
+    fitting = [estimate for estimate in estimates if estimate['withinBudget']]
+    if fitting:
+        best = min(fitting, key=lambda estimate: (estimate['gridSmall'], estimate['patches']))
+    else:
+        best = min(estimates, key=lambda estimate: (estimate['patches'], estimate['gridSmall']))
+    return best, estimates
+
+
+def formatEstimates(estimates, best):
+    """
+    Returns the estimates as text table, the picked one marked with *
+    """
+    lines = ["  {:>7}  {:>7}  {:>9}  {:>9}  {:>10}  {:>11}  {}".format(
+        'Small', 'Large', 'Cells', 'Patches', 'Vertices', 'Bytes', 'Budget')]
+    for estimate in estimates:
+        lines.append("{} {:>7g}  {:>7}  {:>9}  {:>9}  {:>10}  {:>11}  {}".format(
+            '*' if estimate is best else ' ', estimate['gridSmall'],
+            '-' if estimate['gridLarge'] is None else '{:g}'.format(estimate['gridLarge']), estimate['cells'],
+            estimate['patches'], estimate['vertices'], estimate['bytes'], 'ok' if estimate['withinBudget'] else 'over'))
+    return '\n'.join(lines)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Persistent per field cache for incremental regeneration of Sections.txt
+"""
+
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def polygonDigests(polygons):
+    """
+    Returns a hash per polygon, to find the weed polygons added or removed since the last run
+    """
+    digests = []
+    for rings in polygons:
+        digest = hashlib.sha1()
+        for ring in rings:
+            digest.update(np.ascontiguousarray(ring, dtype='<f8').tobytes())
+            digest.update(b'|')
+        digests.append(digest.hexdigest())
+    return np.array(digests, dtype='U40')
+
+
+class FieldCache:
+    """
+    Cache of one field in a cache folder; the file name is a hash of everything that defines
+    the cell grid (boundary geometry, StartFix, grid CRS, grid sizes and engine), so any change
+    of these starts a new cache
+    """
+
+    def __init__(self, directory, key):
+        self.path = os.path.join(directory, 'field-{}.npz'.format(key))
+
+    @staticmethod
+    def cacheKey(boundary, *parts):
+        digest = hashlib.sha256()
+        digest.update(str(CACHE_VERSION).encode())
+        for rings in boundary:
+            for ring in rings:
+                digest.update(np.ascontiguousarray(ring, dtype='<f8').tobytes())
+                digest.update(b'|')
+            digest.update(b'#')
+        digest.update(repr(parts).encode())
+        return digest.hexdigest()[:32]
+
+    def load(self):
+        """
+        Returns the cached arrays as dict, or None if there is no usable cache
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+    def save(self, **arrays):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(temporary, self.path)
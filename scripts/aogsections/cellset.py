@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Compact cell sets: cells of a CellGrid stored as integer row, column and level in NumPy
+   arrays (9 bytes per cell), so that intermediate results of the classification never need
+   cell polygons; set operations work on the indices, polygons (or rects) are only created
+   for the output
+"""
+
+import numpy as np
+
+
+class CellSet:
+    """
+    Cells of grid by level: a cell of level l is a square of spans[l] x spans[l] cells of grid,
+    row and column count in cells of its level from the top left corner of the grid, like the
+    coarser grids of native:creategrid over the same extent (e.g. spans (1, 10) for small and
+    large cells, or (1, 2, 4, ...) for quadtree levels)
+    """
+
+    def __init__(self, grid, rows=(), cols=(), levels=None, spans=(1,)):
+        self.grid = grid
+        self.spans = tuple(int(span) for span in spans)
+        self.rows = np.asarray(rows, dtype=np.int32).ravel()
+        self.cols = np.asarray(cols, dtype=np.int32).ravel()
+        self.levels = np.zeros(len(self.rows), dtype=np.uint8) if levels is None \
+            else np.broadcast_to(np.asarray(levels, dtype=np.uint8), self.rows.shape).copy()
+        if len(self.cols) != len(self.rows):
+            raise ValueError("Rows and columns of the cells differ in length")
+
+    @classmethod
+    def fromMask(cls, grid, mask, level=0, spans=(1,)):
+        """
+        Returns the cells set in mask, a boolean array of the cells of a level
+        """
+        rows, cols = np.nonzero(mask)
+        return cls(grid, rows, cols, level, spans)
+
+    @classmethod
+    def full(cls, grid, level=0, spans=(1,)):
+        """
+        Returns all cells of a level covering grid; cells at the right and bottom border may
+        reach beyond the grid
+        """
+        span = int(spans[level])
+        rows, cols = np.indices((-(-grid.rows // span), -(-grid.cols // span)), dtype=np.int32)
+        return cls(grid, rows, cols, level, spans)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.cols.nbytes + self.levels.nbytes
+
+    def levelCounts(self):
+        """
+        Returns the number of cells of every level
+        """
+        return np.bincount(self.levels, minlength=len(self.spans)).tolist()
+
+    def subset(self, keep):
+        """
+        Returns the cells selected by keep (boolean array or indices)
+        """
+        return CellSet(self.grid, self.rows[keep], self.cols[keep], self.levels[keep], self.spans)
+
+    def _checkCompatible(self, other):
+        if other.grid is not self.grid and (other.grid.xmin, other.grid.ymax, other.grid.size) \
+                != (self.grid.xmin, self.grid.ymax, self.grid.size):
+            raise ValueError("Cell sets of different grids")
+        if other.spans != self.spans:
+            raise ValueError("Cell sets with different levels")
+
+    def keys(self):
+        """
+        Returns a unique int64 key of every cell
+        """
+        return (self.levels.astype(np.int64) << 56) | (self.rows.astype(np.int64) << 28) | self.cols
+
+    def union(self, *others):
+        """
+        Returns the cells of this and the other sets, each cell once
+        """
+        for other in others:
+            self._checkCompatible(other)
+        cells = CellSet(self.grid, np.concatenate([self.rows] + [other.rows for other in others]),
+                        np.concatenate([self.cols] + [other.cols for other in others]),
+                        np.concatenate([self.levels] + [other.levels for other in others]), self.spans)
+        _, first = np.unique(cells.keys(), return_index=True)
+        return cells.subset(np.sort(first))
+
+    def difference(self, other):
+        """
+        Returns the cells that are not covered by a cell of other of the same or a coarser level
+        (spans of coarser levels are multiples of the finer ones)
+        """
+        self._checkCompatible(other)
+        covered = np.zeros(len(self), dtype=bool)
+        for level in np.unique(other.levels).tolist():
+            otherSpan = self.spans[level]
+            candidates = np.flatnonzero(~covered & (np.asarray(self.spans)[self.levels] <= otherSpan))
+            if not len(candidates):
+                continue
+            spans = np.asarray(self.spans, dtype=np.int64)[self.levels[candidates]]
+            # cell of the level containing the top left small cell of each candidate
+            rows = self.rows[candidates].astype(np.int64) * spans // otherSpan
+            cols = self.cols[candidates].astype(np.int64) * spans // otherSpan
+            otherCells = other.levels == level
+            covered[candidates] = np.isin((rows << 28) | cols, (other.rows[otherCells].astype(np.int64) << 28)
+                                          | other.cols[otherCells])
+        return self.subset(~covered)
+
+    def split(self, level=0):
+        """
+        Returns the cells subdivided into the cells of a finer level; cells beyond the grid
+        are left out
+        """
+        span = self.spans[level]
+        factors = np.asarray(self.spans, dtype=np.int64)[self.levels] // span
+        if not len(self) or (factors == 1).all():
+            return CellSet(self.grid, self.rows, self.cols, level, self.spans)
+        rows, cols = [], []
+        for factor in np.unique(factors).tolist():
+            cells = factors == factor
+            offsets = np.arange(factor, dtype=np.int64)
+            rows.append((self.rows[cells, None, None].astype(np.int64) * factor + offsets[:, None])
+                        .repeat(factor, axis=2).ravel())
+            cols.append((self.cols[cells, None, None].astype(np.int64) * factor + offsets[None, :])
+                        .repeat(factor, axis=1).ravel())
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        inside = (rows * span < self.grid.rows) & (cols * span < self.grid.cols)
+        return CellSet(self.grid, rows[inside], cols[inside], level, self.spans)
+
+    def sorted(self):
+        """
+        Returns the cells ordered by level (coarsest first), then row by row, so that
+        neighbours of the same size follow each other
+        """
+        return self.subset(np.lexsort((self.cols, self.rows, -self.levels.astype(np.int16))))
+
+    def mask(self):
+        """
+        Returns the cells of the grid covered by the set as boolean mask
+        """
+        mask = np.zeros((self.grid.rows, self.grid.cols), dtype=bool)
+        for level, span in enumerate(self.spans):
+            cells = self.levels == level
+            if not cells.any():
+                continue
+            blocks = np.zeros((-(-self.grid.rows // span), -(-self.grid.cols // span)), dtype=bool)
+            blocks[self.rows[cells], self.cols[cells]] = True
+            mask |= np.repeat(np.repeat(blocks, span, axis=0), span, axis=1)[:self.grid.rows, :self.grid.cols]
+        return mask
+
+    def rects(self, start=0, stop=None):
+        """
+        Returns left, top, right, bottom of the cells start to stop - 1 as array of shape (n, 4)
+        """
+        size = np.asarray(self.spans, dtype=float)[self.levels[start:stop]] * self.grid.size
+        left = self.grid.xmin + self.cols[start:stop] * size
+        top = self.grid.ymax - self.rows[start:stop] * size
+        return np.column_stack([left, top, left + size, top - size])
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Command line interface, run as: python -m aogsections <command> ...
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+from .batch import formatSummary, readWeedMapping, runBatch
+from .budget import chooseGridSizes, fieldMeasures, formatEstimates
+from .benchmark import PRESETS, benchmarkCases, compareResults, loadResults, runBenchmark, saveResults
+from .fieldfiles import readPolygons
+from .localframe import LocalFrame
+from .pipeline import ENGINES, ENGINE_RASTER_MASK, generateSections
+from .sections import DEFAULT_COLOR, readSections
+from .verify import DEFAULT_RESOLUTION, formatVerification, verifySections
+from .watch import FieldWatcher, serveStatus
+from .weedraster import DEFAULT_THRESHOLD, WeedRaster, readWeeds
+
+
+def parseColor(value):
+    try:
+        color = tuple(int(v) for v in value.split(","))
+    except ValueError:
+        color = ()
+    if len(color) != 3 or not all(0 <= v <= 255 for v in color):
+        raise argparse.ArgumentTypeError("color must be r,g,b with values from 0 to 255")
+    return color
+
+
+def addGridArguments(parser):
+    parser.add_argument('--grid-small', type=float, default=1.0, help='size of the small grid in meters (default 1)')
+    parser.add_argument('--grid-large', type=float, default=10.0,
+                        help='size of the large grid in meters, a multiple of the small size (default 10)')
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINE_RASTER_MASK,
+                        help='mask: small and large grid, quadtree: adaptive cell sizes (default mask)')
+    parser.add_argument('--no-merge-strips', dest='mergeStrips', action='store_false',
+                        help='write every cell as its own patch instead of merging rows to strips')
+    parser.add_argument('--color', type=parseColor, default=DEFAULT_COLOR,
+                        help='color of the applied patches as r,g,b (default 27,151,160)')
+    parser.add_argument('--weed-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='pixels of a weed raster (GeoTIFF) at or above this value are weeds (default 0.5)')
+    parser.add_argument('--tile-size', type=float,
+                        help='process the field in square tiles of this size in meters (rounded up to the '
+                             'large grid), memory then depends on the tile size instead of the field size')
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog='aogsections', description='Section file creator for AGOpenGPS')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='generate Sections.txt for one field')
+    generate.add_argument('--field', required=True, help='AOG Field.txt with the StartFix of the field')
+    generate.add_argument('--boundary', help='field boundary as KML, shapefile or GeoJSON '
+                                             '(default: Field.kml next to Field.txt)')
+    generate.add_argument('--weeds', required=True, help='weed polygons as KML, shapefile or GeoJSON in WGS84, '
+                                                         'or a weed probability raster as GeoTIFF')
+    generate.add_argument('--output', '-o', required=True, help='Sections.txt file to write')
+    generate.add_argument('--cache', help='cache folder; reruns only recalculate the parts of the field '
+                                          'around weeds that changed')
+    generate.add_argument('--workers', type=int, default=1,
+                          help='number of worker processes for the tiles of --tile-size (default 1)')
+    generate.add_argument('--existing', help='existing Sections.txt for --skip-applied and --keep-existing '
+                                             '(default: the output file)')
+    generate.add_argument('--skip-applied', action='store_true',
+                          help='leave out cells already covered by the patches of the existing Sections.txt; '
+                               'if that is the output file, its patches are kept as with --keep-existing')
+    generate.add_argument('--keep-existing', action='store_true',
+                          help='keep the patches of the existing Sections.txt in the new file')
+    addGridArguments(generate)
+    generate.set_defaults(run=runGenerate)
+
+    batch = commands.add_parser('batch', help='generate Sections.txt for all fields of an AOG Fields folder')
+    batch.add_argument('--fields', required=True, help='AOG Fields folder with one folder per field')
+    batch.add_argument('--weeds', help='folder with one weed file per field, named like the field folder')
+    batch.add_argument('--mapping', help='CSV file with field name and weed file per line, '
+                                         'takes precedence over --weeds')
+    batch.add_argument('--workers', type=int, help='number of worker processes (default: number of CPUs)')
+    batch.add_argument('--output-name', default='Sections.txt',
+                       help='name of the file written into each field folder (default Sections.txt)')
+    batch.add_argument('--cache', help='cache folder shared by all fields, see generate')
+    addGridArguments(batch)
+    batch.set_defaults(run=runBatchCommand)
+
+    verify = commands.add_parser('verify', help='compare a Sections.txt with field boundary and weeds')
+    verify.add_argument('--field', required=True, help='AOG Field.txt with the StartFix of the field')
+    verify.add_argument('--boundary', help='field boundary as KML, shapefile or GeoJSON '
+                                           '(default: Field.kml next to Field.txt)')
+    verify.add_argument('--weeds', required=True, help='weed polygons as KML, shapefile or GeoJSON in WGS84, '
+                                                       'or a weed probability raster as GeoTIFF')
+    verify.add_argument('--sections', help='Sections.txt to verify (default: Sections.txt next to Field.txt)')
+    verify.add_argument('--weed-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='pixels of a weed raster (GeoTIFF) at or above this value are weeds (default 0.5)')
+    verify.add_argument('--resolution', type=float, default=DEFAULT_RESOLUTION,
+                        help='pixel size of the check in meters (default 0.1)')
+    verify.add_argument('--max-weed-area', type=float,
+                        help='exit with status 1 if more weed area in square meters is marked as applied; the '
+                             'cells on the field boundary are applied as a whole, so weeds there count as well')
+    verify.set_defaults(run=runVerifyCommand)
+
+    optimize = commands.add_parser('optimize', help='pick the finest grid sizes for which Sections.txt stays '
+                                                    'within a patch count or file size')
+    optimize.add_argument('--field', required=True, help='AOG Field.txt with the StartFix of the field')
+    optimize.add_argument('--boundary', help='field boundary as KML, shapefile or GeoJSON '
+                                             '(default: Field.kml next to Field.txt)')
+    optimize.add_argument('--weeds', required=True, help='weed polygons as KML, shapefile or GeoJSON in WGS84')
+    optimize.add_argument('--max-patches', type=int, help='maximum number of patches in Sections.txt')
+    optimize.add_argument('--max-size', type=float, help='maximum size of Sections.txt in MB')
+    optimize.add_argument('--max-small', type=float, default=1.0,
+                          help='coarsest acceptable small grid size in meters, i.e. the minimum accuracy (default 1)')
+    optimize.add_argument('--engine', choices=ENGINES, default=ENGINE_RASTER_MASK,
+                          help='mask: small and large grid, quadtree: adaptive cell sizes (default mask)')
+    optimize.add_argument('--no-merge-strips', dest='mergeStrips', action='store_false',
+                          help='write every cell as its own patch instead of merging rows to strips')
+    optimize.add_argument('--color', type=parseColor, default=DEFAULT_COLOR,
+                          help='color of the applied patches as r,g,b (default 27,151,160)')
+    optimize.add_argument('--output', '-o', help='write Sections.txt with the picked grid sizes here '
+                                                 '(default: only a temporary file for the actual counts)')
+    optimize.set_defaults(run=runOptimizeCommand)
+
+    watch = commands.add_parser('watch', help='keep the fields of an AOG Fields folder in memory and regenerate '
+                                              'Sections.txt whenever a weed file changes')
+    watch.add_argument('--fields', required=True, help='AOG Fields folder with one folder per field')
+    watch.add_argument('--weeds', help='folder with one weed file per field, named like the field folder')
+    watch.add_argument('--mapping', help='CSV file with field name and weed file per line, '
+                                         'takes precedence over --weeds')
+    watch.add_argument('--output-name', default='Sections.txt',
+                       help='name of the file written into each field folder (default Sections.txt)')
+    watch.add_argument('--interval', type=float, default=1.0, help='seconds between checks of the files (default 1)')
+    watch.add_argument('--status-port', type=int,
+                       help='serve the state of all fields with regeneration times as JSON on '
+                            'http://127.0.0.1:<port>/')
+    addGridArguments(watch)
+    watch.set_defaults(run=runWatchCommand)
+
+    benchmark = commands.add_parser('benchmark', help='time the section calculation on synthetic fields '
+                                                      'and the QGIS example')
+    benchmark.add_argument('--preset', choices=sorted(PRESETS), default='quick',
+                           help='quick: small fields, full: 1 to 500 ha with up to 30000 weeds (default quick)')
+    benchmark.add_argument('--engine', dest='engines', action='append', choices=ENGINES,
+                           help='engine to benchmark, can be given more than once (default mask)')
+    benchmark.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest counts (default 3)')
+    benchmark.add_argument('--no-example', dest='example', action='store_false',
+                           help='skip the QGIS example field')
+    benchmark.add_argument('--output', '-o', help='JSON file for the results')
+    benchmark.add_argument('--compare', help='JSON results of a previous run to compare with')
+    benchmark.add_argument('--tolerance', type=float, default=0.2,
+                           help='relative increase of time or memory that counts as regression (default 0.2)')
+    benchmark.set_defaults(run=runBenchmarkCommand)
+    return parser
+
+
+def runGenerate(args):
+    boundary = args.boundary or os.path.join(os.path.dirname(os.path.abspath(args.field)), 'Field.kml')
+    frame = LocalFrame.fromFieldFile(args.field)
+    print("StartFix is {},{}".format(frame.latStart, frame.lonStart))
+    generateSections(readPolygons(boundary), readWeeds(args.weeds, frame, args.weed_threshold), frame, args.output,
+                     args.grid_small, args.grid_large, args.engine, args.mergeStrips, args.color,
+                     cacheDir=args.cache, tileSize=args.tile_size, workers=args.workers,
+                     existing=args.existing, skipApplied=args.skip_applied,
+                     keepExisting=args.keep_existing, log=print)
+    return 0
+
+
+def runBatchCommand(args):
+    if args.weeds is None and args.mapping is None:
+        raise ValueError("Either --weeds or --mapping is needed to find the weed files")
+    if args.workers is not None and args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+    mapping = readWeedMapping(args.mapping) if args.mapping else None
+    results = runBatch(args.fields, args.weeds, mapping, args.workers, args.output_name, args.grid_small,
+                       args.grid_large, args.engine, args.mergeStrips, args.color, args.cache, args.tile_size,
+                       args.weed_threshold, log=print)
+    print(formatSummary(results))
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+def runVerifyCommand(args):
+    fieldDir = os.path.dirname(os.path.abspath(args.field))
+    frame = LocalFrame.fromFieldFile(args.field)
+    boundary = frame.polygonsToLocal(readPolygons(args.boundary or os.path.join(fieldDir, 'Field.kml')))
+    weeds = readWeeds(args.weeds, frame, args.weed_threshold)
+    if not isinstance(weeds, WeedRaster):
+        weeds = frame.polygonsToLocal(weeds)
+    patches = readSections(args.sections or os.path.join(fieldDir, 'Sections.txt'))
+    result = verifySections(patches, boundary, weeds, args.resolution)
+    print(formatVerification(result))
+    if args.max_weed_area is not None and result['weedCoveredArea'] > args.max_weed_area:
+        print("Failed: {:.2f} m2 of weeds marked as applied".format(result['weedCoveredArea']))
+        return 1
+    return 0
+
+
+def runOptimizeCommand(args):
+    if args.max_patches is None and args.max_size is None:
+        raise ValueError("Either --max-patches or --max-size is needed")
+    boundaryFile = args.boundary or os.path.join(os.path.dirname(os.path.abspath(args.field)), 'Field.kml')
+    frame = LocalFrame.fromFieldFile(args.field)
+    boundary = readPolygons(boundaryFile)
+    weeds = readPolygons(args.weeds)
+    measures = fieldMeasures(frame.polygonsToLocal(boundary), frame.polygonsToLocal(weeds))
+    maxBytes = int(args.max_size * 2 ** 20) if args.max_size is not None else None
+    best, estimates = chooseGridSizes(measures, args.max_patches, maxBytes, args.max_small, args.engine,
+                                      args.mergeStrips, args.color)
+    print(formatEstimates(estimates, best))
+    if not best['withinBudget']:
+        print("No grid sizes fit the budget, using the one with the fewest patches")
+    with tempfile.TemporaryDirectory() as folder:
+        output = args.output or os.path.join(folder, 'Sections.txt')
+        actual = generateSections(boundary, weeds, frame, output, best['gridSmall'], best['gridLarge'], args.engine,
+                                  args.mergeStrips, args.color)
+        actual['bytes'] = os.path.getsize(output)
+    print("Grid small {:g}, large {}:".format(best['gridSmall'], '-' if best['gridLarge'] is None
+                                              else '{:g}'.format(best['gridLarge'])))
+    for name in ('cells', 'patches', 'vertices', 'bytes'):
+        print("  {:<8}  estimated {:>11}  actual {:>11}  ({:+.0%})".format(
+            name, best[name], actual[name], best[name] / actual[name] - 1 if actual[name] else 0))
+    if args.output:
+        print("Sections.txt written to {}".format(args.output))
+    withinBudget = (args.max_patches is None or actual['patches'] <= args.max_patches) \
+        and (maxBytes is None or actual['bytes'] <= maxBytes)
+    if not withinBudget:
+        print("The actual Sections.txt exceeds the budget")
+    return 0 if withinBudget else 1
+
+
+def runWatchCommand(args):
+    if args.weeds is None and args.mapping is None:
+        raise ValueError("Either --weeds or --mapping is needed to find the weed files")
+    mapping = readWeedMapping(args.mapping) if args.mapping else None
+    watcher = FieldWatcher(args.fields, args.weeds, mapping, args.output_name, args.grid_small, args.grid_large,
+                           args.engine, args.mergeStrips, args.color, args.tile_size, args.weed_threshold, log=print)
+    if args.status_port is not None:
+        serveStatus(watcher, args.status_port)
+        print("Status on http://127.0.0.1:{}/".format(args.status_port))
+    try:
+        watcher.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def runBenchmarkCommand(args):
+    previous = loadResults(args.compare) if args.compare else None
+    cases = benchmarkCases(args.preset, args.engines or (ENGINE_RASTER_MASK,),
+                           **({} if args.example else {'example': None}))
+    results = runBenchmark(cases, args.repeat, log=print)
+    if args.output:
+        saveResults(results, args.output)
+        print("Results saved to {}".format(args.output))
+    if previous is None:
+        return 0
+    lines, regressions = compareResults(previous, results, args.tolerance)
+    for case, message in lines:
+        print("{}: {}".format(case, message))
+    print("{} regressions".format(len(regressions)))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    try:
+        return args.run(args)
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Readers for the files of an AgOpenGPS field folder and for weed polygon files;
+   all polygons are returned as lists of rings with longitude / latitude (see geometry.wkbPolygons)
+"""
+
+import os
+import struct
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+# file types readPolygons can read
+POLYGON_EXTENSIONS = ('.kml', '.shp', '.geojson', '.json')
+
+
+def readStartFix(path):
+    """
+    Opens AOG Field.txt and returns the StartFix as (lat, lon)
+    """
+    with open(path, "r") as field:
+        lines = [line.strip() for line in field]
+    try:
+        i = lines.index("StartFix")
+    except ValueError:
+        raise ValueError("No StartFix in {}".format(path))
+    latlon = lines[i + 1].split(",")
+    return float(latlon[0]), float(latlon[1])
+
+
+def readKmlPolygons(path):
+    """
+    Reads all polygons of a KML file, e.g. Field.kml of an AOG field
+    """
+    polygons = []
+    for element in ElementTree.parse(path).iter():
+        if _localName(element.tag) != 'Polygon':
+            continue
+        rings = []
+        for boundary in element:
+            if _localName(boundary.tag) not in ('outerBoundaryIs', 'innerBoundaryIs'):
+                continue
+            for coordinates in boundary.iter():
+                if _localName(coordinates.tag) == 'coordinates' and coordinates.text:
+                    rings.append(np.array([[float(v) for v in point.split(",")[:2]]
+                                           for point in coordinates.text.split()]))
+        if rings:
+            polygons.append(rings)
+    return polygons
+
+
+def _localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def readShapefilePolygons(path):
+    """
+    Reads all polygons of an ESRI shapefile; every record becomes one polygon with all of its rings.
+    The shapefile must use WGS84 coordinates
+    """
+    prj = os.path.splitext(path)[0] + '.prj'
+    if os.path.exists(prj):
+        with open(prj, "r") as file:
+            if not file.read().lstrip().upper().startswith('GEOGCS'):
+                raise ValueError("{} must use geographic WGS84 coordinates".format(path))
+
+    with open(path, "rb") as file:
+        data = file.read()
+    polygons = []
+    offset = 100
+    while offset + 8 <= len(data):
+        length, = struct.unpack_from('>i', data, offset + 4)
+        content = offset + 8
+        offset = content + 2 * length
+        shapeType, = struct.unpack_from('<i', data, content)
+        if shapeType == 0:
+            continue
+        if shapeType not in (5, 15, 25):
+            raise ValueError("{} does not contain polygons (shape type {})".format(path, shapeType))
+        numParts, numPoints = struct.unpack_from('<ii', data, content + 36)
+        parts = list(struct.unpack_from('<{}i'.format(numParts), data, content + 44)) + [numPoints]
+        points = np.frombuffer(data, dtype='<f8', count=2 * numPoints,
+                               offset=content + 44 + 4 * numParts).reshape(numPoints, 2)
+        polygons.append([points[parts[i]:parts[i + 1]].copy() for i in range(numParts)])
+    return polygons
+
+
+def readGeoJsonPolygons(path):
+    """
+    Reads all Polygon and MultiPolygon geometries of a GeoJSON file
+    """
+    import json
+    with open(path, "r") as file:
+        data = json.load(file)
+    geometries = []
+    if data.get('type') == 'FeatureCollection':
+        geometries = [feature.get('geometry') for feature in data.get('features', [])]
+    elif data.get('type') == 'Feature':
+        geometries = [data.get('geometry')]
+    else:
+        geometries = [data]
+
+    polygons = []
+    for geometry in geometries:
+        if not geometry:
+            continue
+        if geometry['type'] == 'Polygon':
+            parts = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            parts = geometry['coordinates']
+        else:
+            continue
+        for part in parts:
+            polygons.append([np.array(ring, dtype=float)[:, :2] for ring in part])
+    return polygons
+
+
+def readPolygons(path):
+    """
+    Reads the polygons of a KML, shapefile or GeoJSON file
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.kml':
+        return readKmlPolygons(path)
+    if extension == '.shp':
+        return readShapefilePolygons(path)
+    if extension in ('.geojson', '.json'):
+        return readGeoJsonPolygons(path)
+    raise ValueError("Unsupported polygon file {}, use KML, shapefile or GeoJSON".format(path))
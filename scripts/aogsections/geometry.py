@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Geometry of the section calculation: polygons from WKB, the cell grid and the
+   raster mask engine that classifies grid cells against field boundary and weeds.
+   Polygons are lists of rings, each ring a numpy array of shape (n, 2)
+"""
+
+import struct
+
+import numpy as np
+
+
+def wkbRingLayout(wkb):
+    """
+    Returns (offset, dimension, littleEndian) of the exterior ring coordinates of the first
+    polygon in a Polygon / MultiPolygon WKB, or None if the geometry is of another type
+    or has less than four vertices
+    """
+    offset = 0
+    while True:
+        littleEndian = wkb[offset] == 1
+        order = '<' if littleEndian else '>'
+        wkbType, = struct.unpack_from(order + 'I', wkb, offset + 1)
+        baseType = wkbType & 0x0fffffff
+        hasZ = bool(wkbType & 0x80000000) or baseType // 1000 in (1, 3)
+        hasM = bool(wkbType & 0x40000000) or baseType // 1000 in (2, 3)
+        baseType = baseType % 1000
+        if baseType == 6:
+            # MultiPolygon: continue with the first part
+            numParts, = struct.unpack_from(order + 'I', wkb, offset + 5)
+            if numParts < 1:
+                return None
+            offset = offset + 9
+            continue
+        if baseType != 3:
+            return None
+        numRings, numPoints = struct.unpack_from(order + 'II', wkb, offset + 5)
+        if numRings < 1 or numPoints < 4:
+            return None
+        return offset + 13, 2 + hasZ + hasM, littleEndian
+
+
+def wkbPolygons(wkb):
+    """
+    Parses a Polygon / MultiPolygon WKB and returns a list of polygons,
+    each polygon being a list of rings as numpy arrays of shape (n, 2)
+    """
+    polygons = []
+    _readWkbPolygons(wkb, 0, polygons)
+    return polygons
+
+
+def polygonWkb(polygon):
+    """
+    Returns a polygon given as list of rings as little endian 2D Polygon WKB
+    """
+    parts = [struct.pack('<BII', 1, 3, len(polygon))]
+    for ring in polygon:
+        ring = np.ascontiguousarray(ring, dtype='<f8')
+        parts.append(struct.pack('<I', len(ring)))
+        parts.append(ring.tobytes())
+    return b''.join(parts)
+
+
+def _readWkbPolygons(wkb, offset, polygons):
+    littleEndian = wkb[offset] == 1
+    order = '<' if littleEndian else '>'
+    wkbType, count = struct.unpack_from(order + 'II', wkb, offset + 1)
+    baseType = wkbType & 0x0fffffff
+    dimension = 2 + (bool(wkbType & 0x80000000) or baseType // 1000 in (1, 3)) \
+        + (bool(wkbType & 0x40000000) or baseType // 1000 in (2, 3))
+    baseType = baseType % 1000
+    offset = offset + 9
+    if baseType == 6:
+        for _ in range(count):
+            offset = _readWkbPolygons(wkb, offset, polygons)
+        return offset
+    if baseType != 3:
+        raise ValueError("Unsupported geometry type {}, expected polygons".format(wkbType))
+    rings = []
+    for _ in range(count):
+        numPoints, = struct.unpack_from(order + 'I', wkb, offset)
+        coords = np.frombuffer(wkb, dtype=order + 'f8', count=numPoints * dimension, offset=offset + 4)
+        rings.append(coords.reshape(numPoints, dimension)[:, :2].astype(float))
+        offset = offset + 4 + numPoints * dimension * 8
+    polygons.append(rings)
+    return offset
+
+
+class CellGrid:
+    """
+    Regular grid of square cells anchored at the top left corner of an extent,
+    like the grids of native:creategrid; row 0 is the top row
+    """
+
+    def __init__(self, xmin, ymax, size, rows, cols):
+        self.xmin = xmin
+        self.ymax = ymax
+        self.size = size
+        self.rows = rows
+        self.cols = cols
+
+    @classmethod
+    def fromExtent(cls, xmin, ymin, xmax, ymax, size):
+        rows = max(int(np.ceil((ymax - ymin) / size)), 1)
+        cols = max(int(np.ceil((xmax - xmin) / size)), 1)
+        return cls(xmin, ymax, size, rows, cols)
+
+    def cellRects(self, mask, size=None):
+        """
+        Returns left, top, right, bottom of the cells set in mask as array of shape (n, 4);
+        size is the cell size of the mask if it differs from the grid cell size
+        """
+        size = self.size if size is None else size
+        rows, cols = np.nonzero(mask)
+        left = self.xmin + cols * size
+        top = self.ymax - rows * size
+        return np.column_stack([left, top, left + size, top - size])
+
+    def window(self, row0, row1, col0, col1):
+        """
+        Returns the part of the grid with rows row0 to row1 - 1 and columns col0 to col1 - 1
+        """
+        return CellGrid(self.xmin + col0 * self.size, self.ymax - row0 * self.size, self.size,
+                        row1 - row0, col1 - col0)
+
+    def cellWindows(self, boxes, margin=1):
+        """
+        Returns row0, row1, col0, col1 of the cells touching each box xmin, ymin, xmax, ymax
+        as array of shape (n, 4), widened by margin cells and clipped to the grid;
+        boxes with nan give empty windows
+        """
+        boxes = np.nan_to_num(np.asarray(boxes, dtype=float).reshape(-1, 4), nan=np.inf)
+        with np.errstate(invalid='ignore'):
+            windows = np.column_stack([
+                np.floor((self.ymax - boxes[:, 3]) / self.size) - margin,
+                np.floor((self.ymax - boxes[:, 1]) / self.size) + 1 + margin,
+                np.floor((boxes[:, 0] - self.xmin) / self.size) - margin,
+                np.floor((boxes[:, 2] - self.xmin) / self.size) + 1 + margin])
+        windows = np.nan_to_num(windows, nan=0, posinf=0, neginf=0)
+        return np.clip(windows, 0, [self.rows, self.rows, self.cols, self.cols]).astype(np.int64)
+
+    def windowExtent(self, row0, row1, col0, col1):
+        """
+        Returns xmin, ymin, xmax, ymax of a window of cells
+        """
+        return (self.xmin + col0 * self.size, self.ymax - row1 * self.size,
+                self.xmin + col1 * self.size, self.ymax - row0 * self.size)
+
+
+def polygonEdges(polygons):
+    """
+    Returns the edges of all rings as array of shape (n, 4) with x0, y0, x1, y1
+    and the index of the polygon each edge belongs to
+    """
+    edges = []
+    ids = []
+    for i, rings in enumerate(polygons):
+        for ring in rings:
+            if len(ring) < 3:
+                continue
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            edges.append(np.hstack([ring[:-1], ring[1:]]))
+            ids.append(np.full(len(ring) - 1, i))
+    if not edges:
+        return np.empty((0, 4)), np.empty(0, dtype=np.int64)
+    return np.concatenate(edges), np.concatenate(ids)
+
+
+def rasterizePolygons(edges, ids, grid):
+    """
+    Returns a boolean mask of the cells whose center lies within one of the polygons;
+    even-odd scanline fill along the row centers, done per polygon so that
+    overlapping polygons do not cancel out each other
+    """
+    if not len(edges):
+        return np.zeros((grid.rows, grid.cols), dtype=bool)
+    # coordinates in cell units relative to the first cell center
+    u0 = (edges[:, 0] - grid.xmin) / grid.size - 0.5
+    v0 = (grid.ymax - edges[:, 1]) / grid.size - 0.5
+    u1 = (edges[:, 2] - grid.xmin) / grid.size - 0.5
+    v1 = (grid.ymax - edges[:, 3]) / grid.size - 0.5
+
+    # an edge crosses the center line of row r if min(v0, v1) <= r < max(v0, v1);
+    # rows outside the grid are dropped as a whole, which keeps the crossings per row even
+    first = np.clip(np.ceil(np.minimum(v0, v1)), 0, grid.rows).astype(np.int64)
+    last = np.clip(np.ceil(np.maximum(v0, v1)), 0, grid.rows).astype(np.int64)
+    counts = last - first
+    edge = np.repeat(np.arange(len(edges)), counts)
+    row = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    u = u0[edge] + (row - v0[edge]) * (u1[edge] - u0[edge]) / (v1[edge] - v0[edge])
+
+    # pairs of consecutive crossings of the same polygon and row enclose the interior
+    order = np.lexsort((u, row, ids[edge]))
+    row = row[order][0::2]
+    u = u[order]
+    start = np.clip(np.ceil(u[0::2]), 0, grid.cols).astype(np.int64)
+    end = np.clip(np.floor(u[1::2]) + 1, 0, grid.cols).astype(np.int64)
+    valid = end > start
+
+    width = grid.cols + 1
+    spans = np.bincount(row[valid] * width + start[valid], minlength=grid.rows * width) \
+        - np.bincount(row[valid] * width + end[valid], minlength=grid.rows * width)
+    return np.cumsum(spans.reshape(grid.rows, width), axis=1)[:, :grid.cols] > 0
+
+
+def _gridLineCrossings(a0, a1):
+    """
+    Returns edge index and parameter t of all crossings of the edges a0 -> a1
+    with the integer grid lines strictly between a0 and a1
+    """
+    first = np.floor(np.minimum(a0, a1)) + 1
+    counts = np.maximum(np.ceil(np.maximum(a0, a1)) - first, 0).astype(np.int64)
+    edge = np.repeat(np.arange(len(a0)), counts)
+    k = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return edge, (k - a0[edge]) / (a1[edge] - a0[edge])
+
+
+def traceEdges(edges, grid):
+    """
+    Returns a boolean mask of the cells whose interior is crossed by one of the edges
+    """
+    mask = np.zeros((grid.rows, grid.cols), dtype=bool)
+    # skip edges that are completely outside of the grid
+    xmax = grid.xmin + grid.cols * grid.size
+    ymin = grid.ymax - grid.rows * grid.size
+    edges = edges[(np.maximum(edges[:, 0], edges[:, 2]) >= grid.xmin)
+                  & (np.minimum(edges[:, 0], edges[:, 2]) <= xmax)
+                  & (np.maximum(edges[:, 1], edges[:, 3]) >= ymin)
+                  & (np.minimum(edges[:, 1], edges[:, 3]) <= grid.ymax)]
+    if not len(edges):
+        return mask
+    # coordinates in cell units, cell (r, c) covers [c, c + 1) x [r, r + 1)
+    u0 = (edges[:, 0] - grid.xmin) / grid.size
+    v0 = (grid.ymax - edges[:, 1]) / grid.size
+    du = (edges[:, 2] - grid.xmin) / grid.size - u0
+    dv = (grid.ymax - edges[:, 3]) / grid.size - v0
+
+    # split every edge at the grid lines; each piece lies within a single cell
+    n = len(edges)
+    edgeU, tU = _gridLineCrossings(u0, u0 + du)
+    edgeV, tV = _gridLineCrossings(v0, v0 + dv)
+    edge = np.concatenate([np.arange(n), np.arange(n), edgeU, edgeV])
+    t = np.concatenate([np.zeros(n), np.ones(n), tU, tV])
+    order = np.lexsort((t, edge))
+    edge = edge[order]
+    t = t[order]
+    piece = (edge[1:] == edge[:-1]) & (t[1:] > t[:-1])
+    edge = edge[:-1][piece]
+    t = (t[:-1][piece] + t[1:][piece]) / 2
+
+    u = u0[edge] + t * du[edge]
+    v = v0[edge] + t * dv[edge]
+    # pieces running exactly along a grid line only touch the cells on both sides
+    onLine = ((du[edge] == 0) & (u == np.floor(u))) | ((dv[edge] == 0) & (v == np.floor(v)))
+    col = np.floor(u).astype(np.int64)
+    row = np.floor(v).astype(np.int64)
+    valid = ~onLine & (row >= 0) & (row < grid.rows) & (col >= 0) & (col < grid.cols)
+    mask[row[valid], col[valid]] = True
+    return mask
+
+
+def classifyBoundaryCells(boundary, grid):
+    """
+    Classifies the small cells of grid against the field boundary. Returns the boolean
+    masks inside (cells within the field boundary) and edge (cells overlapping the field boundary)
+    """
+    boundaryEdges, boundaryIds = polygonEdges(boundary)
+    edge = traceEdges(boundaryEdges, grid)
+    return rasterizePolygons(boundaryEdges, boundaryIds, grid) & ~edge, edge
+
+
+def weedCells(weeds, grid):
+    """
+    Returns a boolean mask of the small cells whose interior intersects a weed polygon
+    """
+    weedEdges, weedIds = polygonEdges(weeds)
+    return rasterizePolygons(weedEdges, weedIds, grid) | traceEdges(weedEdges, grid)
+
+
+def coveredCells(triangles, grid, samples=2):
+    """
+    Returns a boolean mask of the cells covered by triangles (array of shape (n, 3, 2)), e.g.
+    the applied patches of an existing Sections.txt; a cell is covered if the centers of all
+    samples x samples sub cells lie within one of the triangles
+    """
+    edges = np.concatenate([triangles, np.roll(triangles, -1, axis=1)], axis=2).reshape(-1, 4)
+    ids = np.repeat(np.arange(len(triangles)), 3)
+    fine = CellGrid(grid.xmin, grid.ymax, grid.size / samples, grid.rows * samples, grid.cols * samples)
+    inside = rasterizePolygons(edges, ids, fine)
+    return inside.reshape(grid.rows, samples, grid.cols, samples).all(axis=(1, 3))
+
+
+def classifyFreeCells(boundary, weeds, grid):
+    """
+    Classifies the small cells of grid against the field boundary and weed polygons.
+    Returns the boolean masks free (cells within field boundary minus weeds) and
+    edge (cells overlapping the field boundary)
+    """
+    inside, edge = classifyBoundaryCells(boundary, grid)
+    return inside & ~weedCells(weeds, grid), edge
+
+
+def _blockAll(mask, factor):
+    """
+    Reduces mask to blocks of factor x factor cells, a block is set if all of its cells are set;
+    the mask is padded at the right and bottom like the larger grids of native:creategrid
+    """
+    rows = -(-mask.shape[0] // factor)
+    cols = -(-mask.shape[1] // factor)
+    padded = np.zeros((rows * factor, cols * factor), dtype=bool)
+    padded[:mask.shape[0], :mask.shape[1]] = mask
+    return padded.reshape(rows, factor, cols, factor).all(axis=(1, 3))
+
+
+def _expand(blocks, factor, shape):
+    """
+    Inverse of _blockAll: returns the cells of shape covered by the set blocks
+    """
+    return np.repeat(np.repeat(blocks, factor, axis=0), factor, axis=1)[:shape[0], :shape[1]]
+
+
+def classifyMaskCells(boundary, weeds, grid, factor):
+    """
+    Classifies the small cells of grid against the field boundary and weed polygons,
+    with the same semantics as the vector overlay chain:
+    - boundary: small cells overlapping the field boundary
+    - small: small cells within field boundary minus weeds, not part of a large cell
+    - large: blocks of factor x factor small cells within field boundary minus weeds
+    Returns the boolean masks large, small and boundary
+    """
+    free, edge = classifyFreeCells(boundary, weeds, grid)
+    large, small = blockCells(free, factor)
+    return large, small, edge
+
+
+def blockCells(free, factor):
+    """
+    Splits the free cells into large cells (blocks of factor x factor free cells) and the
+    remaining small cells. Returns the boolean masks large and small
+    """
+    large = _blockAll(free, factor)
+    return large, free & ~_expand(large, factor, free.shape)
+
+
+def quadtreeLevels(shape):
+    """
+    Level of the coarsest power of two multiple of the cell size that fits into a grid of shape
+    """
+    return max(int(np.log2(min(shape))), 0)
+
+
+def quadtreeCells(free, top=None):
+    """
+    Decomposes the free cells into a quadtree: starting with the coarsest power of two
+    multiple of the cell size that fits into the grid (or level top), a cell is only subdivided
+    if not all of its small cells are free. Returns a list of masks, index is the level and the
+    cell size of a level is 2 ** level small cells
+    """
+    top = quadtreeLevels(free.shape) if top is None else top
+    full = [free]
+    for _ in range(top):
+        full.append(_blockAll(full[-1], 2))
+    # a cell is emitted on the coarsest level where it is completely free
+    return [full[level] & ~_expand(full[level + 1], 2, full[level].shape) for level in range(top)] + [full[top]]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""
+   AOG local coordinates: AgOpenGPS works internally with easting / northing in meters
+   relative to the StartFix of a field, using a simple meters per degree model
+"""
+
+from math import cos
+
+import numpy as np
+
+DEG_TO_RAD = 0.01745329251994329576923690766743
+
+
+def metersPerDegreeLat(lat):
+    return 111132.92 - 559.82 * cos(2.0 * lat * DEG_TO_RAD) + 1.175 * cos(
+        4.0 * lat * DEG_TO_RAD) - 0.0023 * cos(6.0 * lat * DEG_TO_RAD)
+
+
+def metersPerDegreeLon(lat):
+    """
+    Meters per degree longitude at the given latitudes (array); evaluated per vertex like
+    the conversion of the original QGIS script, which only uses the first two terms
+    """
+    lat = np.asarray(lat, dtype=float)
+    # math.cos instead of np.cos: SIMD builds of numpy may differ in the last bit,
+    # which would change the rounded output compared to the scalar conversion
+    cosLat = np.fromiter(map(cos, (lat * DEG_TO_RAD).ravel().tolist()), dtype=float, count=lat.size)
+    cos3Lat = np.fromiter(map(cos, (3.0 * lat * DEG_TO_RAD).ravel().tolist()), dtype=float, count=lat.size)
+    return (111412.84 * cosLat - 93.5 * cos3Lat).reshape(lat.shape)
+
+
+class LocalFrame:
+    """
+    AOG local tangent frame anchored at the StartFix of a field
+    """
+
+    def __init__(self, latStart, lonStart):
+        self.latStart = latStart
+        self.lonStart = lonStart
+        self.mPerDegreeLat = metersPerDegreeLat(latStart)
+
+    @classmethod
+    def fromFieldFile(cls, path):
+        from .fieldfiles import readStartFix
+        return cls(*readStartFix(path))
+
+    def toLocal(self, lat, lon):
+        """
+        Converts arrays of latitude / longitude to arrays of easting / northing
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        northing = (lat - self.latStart) * self.mPerDegreeLat
+        easting = (lon - self.lonStart) * metersPerDegreeLon(lat)
+        return easting, northing
+
+    def toWGS84(self, easting, northing):
+        """
+        Inverse of toLocal, returns arrays of latitude / longitude
+        """
+        lat = self.latStart + np.asarray(northing, dtype=float) / self.mPerDegreeLat
+        lon = self.lonStart + np.asarray(easting, dtype=float) / metersPerDegreeLon(lat)
+        return lat, lon
+
+    def polygonsToLocal(self, polygons):
+        """
+        Converts polygons with longitude / latitude rings (see geometry.wkbPolygons) to easting / northing
+        """
+        return [[np.column_stack(self.toLocal(ring[:, 1], ring[:, 0])) for ring in rings] for rings in polygons]
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Section calculation without QGIS: classifies the cells of field boundary minus weeds
+   and writes them as already applied patches to Sections.txt
+"""
+
+import os
+import time
+
+import numpy as np
+
+from .cache import FieldCache, polygonDigests
+from .geometry import (CellGrid, blockCells, classifyBoundaryCells, coveredCells, quadtreeCells, quadtreeLevels,
+                       weedCells)
+from .sections import CHUNK_SIZE, DEFAULT_COLOR, SectionsWriter, readSections, rectCorners, stripStarts
+from .spatialindex import BoxIndex, polygonBoxes
+from .weedraster import WeedRaster
+
+ENGINE_RASTER_MASK = 'mask'
+ENGINE_QUADTREE = 'quadtree'
+ENGINES = (ENGINE_RASTER_MASK, ENGINE_QUADTREE)
+
+
+def _noLog(message):
+    pass
+
+
+def polygonBounds(polygons):
+    """
+    Returns xmin, ymin, xmax, ymax of all polygons
+    """
+    points = np.concatenate([ring for rings in polygons for ring in rings])
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def checkGridSizes(gridSmall, gridLarge):
+    if gridSmall <= 0:
+        raise ValueError("Size of grid small must be positive")
+    if gridLarge is not None and not gridLarge >= gridSmall:
+        raise ValueError("Size of grid large must be at least the size of grid small")
+    # with a tolerance, sizes like 0.2 and 2.0 are no exact multiples as floats
+    if gridLarge is not None and abs(round(gridLarge / gridSmall) * gridSmall - gridLarge) > 1e-9 * gridLarge:
+        raise ValueError("Size of grid large must be a multiple of the size of grid small!")
+
+
+class FieldGrid:
+    """
+    Cell grid of a field with the classification against the field boundary, which stays
+    the same between runs with new weeds. Cells are emitted in bands of rows: a band is one
+    row of large cells (or of top level quadtree cells), so the cells of a band only depend
+    on the weeds within the band
+    """
+
+    def __init__(self, grid, inside, edge, gridLarge=None, engine=ENGINE_RASTER_MASK):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine {}, use one of {}".format(engine, ', '.join(ENGINES)))
+        checkGridSizes(grid.size, gridLarge if engine == ENGINE_RASTER_MASK else None)
+        self.grid = grid
+        self.inside = inside
+        self.edge = edge
+        self.engine = engine
+        if engine == ENGINE_QUADTREE:
+            self.top = quadtreeLevels((grid.rows, grid.cols))
+            self.bandRows = 2 ** self.top
+        else:
+            self.factor = int(round(gridLarge / grid.size))
+            self.bandRows = self.factor
+        self.bandCount = -(-grid.rows // self.bandRows)
+
+    @classmethod
+    def fromBoundary(cls, boundary, gridSmall, gridLarge=None, engine=ENGINE_RASTER_MASK, extent=None):
+        """
+        Creates the grid for the field boundary, anchored at the top left corner of extent
+        (default: bounds of the boundary)
+        """
+        if not boundary:
+            raise ValueError("No field boundary polygon")
+        checkGridSizes(gridSmall, None)
+        xmin, ymin, xmax, ymax = extent if extent is not None else polygonBounds(boundary)
+        grid = CellGrid.fromExtent(xmin, ymin, xmax, ymax, gridSmall)
+        inside, edge = classifyBoundaryCells(boundary, grid)
+        return cls(grid, inside, edge, gridLarge, engine)
+
+    def weedMask(self, weeds, window=None):
+        """
+        Returns the weed cells of the whole grid or of a window (row0, row1, col0, col1);
+        weeds are polygons or a WeedRaster
+        """
+        grid = self.grid if window is None else self.grid.window(*window)
+        if isinstance(weeds, WeedRaster):
+            return weeds.cellMask(grid)
+        return weedCells(weeds, grid)
+
+    def bandCells(self, weedy, band):
+        """
+        Returns left, top, right, bottom of the applied cells in a band; cells of the same
+        size follow each other row by row
+        """
+        row0 = band * self.bandRows
+        row1 = min(row0 + self.bandRows, self.grid.rows)
+        grid = self.grid.window(row0, row1, 0, self.grid.cols)
+        free = self.inside[row0:row1] & ~weedy[row0:row1]
+        edge = self.edge[row0:row1]
+        if self.engine == ENGINE_QUADTREE:
+            levels = quadtreeCells(free, self.top)
+            # cells of the same size in one mask, so that neighbours follow each other row by row
+            levels[0] = levels[0] | edge
+            return np.concatenate([grid.cellRects(levels[level], grid.size * 2 ** level)
+                                   for level in range(len(levels) - 1, -1, -1)])
+        large, small = blockCells(free, self.factor)
+        return np.concatenate([grid.cellRects(large, grid.size * self.factor), grid.cellRects(small | edge)])
+
+    def cells(self, weedy):
+        """
+        Returns the applied cells of all bands, in band order (see bandCells)
+        """
+        return np.concatenate([self.bandCells(weedy, band) for band in range(self.bandCount)])
+
+
+def logCellCounts(cells, edgeCount, gridSmall, engine, log):
+    sizes, counts = np.unique(np.round(cells[:, 2] - cells[:, 0], 9), return_counts=True)
+    # the cells on the field boundary are small cells as well
+    counts[sizes == round(gridSmall, 9)] -= edgeCount
+    if engine == ENGINE_QUADTREE:
+        for size, count in zip(sizes[::-1].tolist(), counts[::-1].tolist()):
+            log("Quadtree: {} cells of size {}".format(count, size))
+        log("Quadtree: {} cells on field boundary".format(edgeCount))
+    else:
+        small = int(counts[sizes == round(gridSmall, 9)].sum())
+        log("Raster mask: {} large cells, {} small cells, {} cells on field boundary".format(
+            int(counts.sum()) - small, small, edgeCount))
+
+
+def logClassification(fieldGrid, weeds, boundaryTime, weedTime, log):
+    log("Classified {} x {} cells against the field boundary in {:.2f} s and against {} in {:.2f} s".format(
+        fieldGrid.grid.rows, fieldGrid.grid.cols, boundaryTime,
+        weeds if isinstance(weeds, WeedRaster) else "{} weed polygons".format(len(weeds)), weedTime))
+
+
+def sectionCells(boundary, weeds, gridSmall, gridLarge=None, engine=ENGINE_RASTER_MASK, extent=None, applied=None,
+                 log=_noLog):
+    """
+    Calculates the cells that are marked as applied: field boundary minus weeds, filled with
+    large and small cells (or quadtree cells), plus the small cells on the field boundary.
+    The grid is anchored at the top left corner of extent (default: bounds of the boundary).
+    Small cells covered by the triangles applied (e.g. of an existing Sections.txt) are left out.
+    Returns an array of shape (n, 4) with left, top, right, bottom of the cells; within a band
+    (see FieldGrid), cells of the same size follow each other row by row
+    """
+    start = time.perf_counter()
+    fieldGrid = FieldGrid.fromBoundary(boundary, gridSmall, gridLarge, engine, extent)
+    boundaryTime = time.perf_counter() - start
+    if applied is not None and len(applied):
+        covered = coveredCells(applied, fieldGrid.grid)
+        skipped = int((covered & (fieldGrid.inside | fieldGrid.edge)).sum())
+        fieldGrid.inside &= ~covered
+        fieldGrid.edge &= ~covered
+        log("Skipped {} small cells already covered by applied patches".format(skipped))
+    start = time.perf_counter()
+    weedy = fieldGrid.weedMask(weeds)
+    logClassification(fieldGrid, weeds, boundaryTime, time.perf_counter() - start, log)
+    cells = fieldGrid.cells(weedy)
+    logCellCounts(cells, int(fieldGrid.edge.sum()), gridSmall, engine, log)
+    return cells
+
+
+def writeCells(writer, rects, mergeStrips, cellCorners=rectCorners):
+    for start in range(0, len(rects), CHUNK_SIZE):
+        chunk = rects[start:start + CHUNK_SIZE]
+        writer.writeCells(cellCorners(chunk), stripStarts(chunk, mergeStrips))
+
+
+def generateSections(boundary, weeds, frame, path, gridSmall=1.0, gridLarge=10.0, engine=ENGINE_RASTER_MASK,
+                     mergeStrips=True, color=DEFAULT_COLOR, cacheDir=None, tileSize=None, workers=1, existing=None,
+                     skipApplied=False, keepExisting=False, log=_noLog):
+    """
+    Generates Sections.txt at path for field boundary and weed polygons with longitude / latitude
+    rings, or a WeedRaster for the AOG local coordinates of frame (see readWeeds); the grid is
+    calculated in the AOG local frame (easting / northing), so the cell corners are written
+    without any further conversion. With a cache folder, only the parts
+    affected by changed weeds are recalculated (see updateSections); with a tile size in meters,
+    the field is processed tile by tile with up to workers processes (see tiling).
+    An existing Sections.txt can be taken into account: with skipApplied, cells already covered
+    by its patches are not generated again, with keepExisting its patches are kept in the new
+    file; existing defaults to path itself if either is set. Skipping the applied cells of path
+    itself always keeps its patches, otherwise they would be lost.
+    Returns a dict with the number of cells, patches and vertices
+    """
+    if cacheDir is not None and tileSize is not None:
+        raise ValueError("Cache folder and tiles can not be combined")
+    if cacheDir is not None and isinstance(weeds, WeedRaster):
+        raise ValueError("Cache folder and weed rasters can not be combined")
+    if cacheDir is not None and (skipApplied or keepExisting):
+        raise ValueError("Cache folder and existing Sections.txt can not be combined")
+    if tileSize is not None and skipApplied:
+        raise ValueError("Tiles and skipping applied cells can not be combined")
+    if existing is None and (skipApplied or keepExisting):
+        existing = path
+    if skipApplied and not keepExisting and os.path.abspath(existing) == os.path.abspath(path):
+        keepExisting = True
+        log("Keeping the patches of {}, its applied cells are skipped".format(path))
+    patches = None
+    if existing is not None and (skipApplied or keepExisting) and os.path.exists(existing):
+        patches = readSections(existing)
+        log("{} patches with {} vertices in {}".format(patches.patchCount, len(patches.vertices), existing))
+    keepPatches = patches if keepExisting else None
+    boundary = frame.polygonsToLocal(boundary)
+    if not isinstance(weeds, WeedRaster):
+        weeds = frame.polygonsToLocal(weeds)
+    if tileSize is not None:
+        # imported here, tiling builds on this module
+        from .tiling import generateTiledSections
+        return generateTiledSections(boundary, weeds, path, gridSmall, gridLarge, engine, mergeStrips, color,
+                                     tileSize, workers, keepPatches=keepPatches, log=log)
+    if cacheDir is not None:
+        return updateSections(boundary, weeds, path, cacheDir, gridSmall, gridLarge, engine, mergeStrips, color,
+                              keyParts=(frame.latStart, frame.lonStart, 'AOG local'), log=log)
+
+    applied = patches.triangles() if patches is not None and skipApplied else None
+    cells = sectionCells(boundary, weeds, gridSmall, gridLarge, engine, applied=applied, log=log)
+    with SectionsWriter(path, color) as writer:
+        if keepPatches is not None:
+            writer.writePatches(keepPatches)
+        writeCells(writer, cells, mergeStrips)
+    log("Wrote {} patches with {} vertices to {}".format(writer.patchCount, writer.vertexCount, path))
+    return {'cells': len(cells), 'patches': writer.patchCount, 'vertices': writer.vertexCount}
+
+
+def _outputUnchanged(cached, path, outputKey):
+    """
+    Checks that Sections.txt is still the file written in the last run with the same options
+    """
+    if str(cached['outputKey']) != outputKey or str(cached['outputPath']) != os.path.abspath(path):
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == int(cached['outputSize']) and stat.st_mtime_ns == int(cached['outputMtime'])
+
+
+def updateSections(boundary, weeds, path, cacheDir, gridSmall=1.0, gridLarge=10.0, engine=ENGINE_RASTER_MASK,
+                   mergeStrips=True, color=DEFAULT_COLOR, keyParts=(), extent=None, cellCorners=rectCorners,
+                   onCells=None, log=_noLog):
+    """
+    Incremental version of sectionCells and writing Sections.txt for polygons in grid coordinates.
+    The cache in cacheDir holds the boundary classification, the weed cells and hashes of the
+    weed polygons of the last run, and the position of every band in the last Sections.txt.
+    Only the cells around weed polygons that were added, removed or changed are reclassified;
+    Sections.txt is patched by rewriting the affected bands and copying all other bands from
+    the previous file. keyParts identify the coordinate system of the polygons (e.g. StartFix
+    and grid CRS); cellCorners converts cells to AOG local corners (default: the grid is in AOG
+    local coordinates); onCells is called with the cells of every band, e.g. to create an output layer.
+    Returns a dict with the number of patches and vertices and the rewritten and total bands
+    """
+    if isinstance(weeds, WeedRaster):
+        raise ValueError("The cache needs weed polygons, weed rasters are not supported")
+    gridLarge = gridLarge if engine == ENGINE_RASTER_MASK else None
+    os.makedirs(cacheDir, exist_ok=True)
+    cache = FieldCache(cacheDir, FieldCache.cacheKey(boundary, keyParts, gridSmall, gridLarge, engine, extent))
+    cached = cache.load()
+    if cached is None:
+        log("No cache for this field and grid, calculating the full grid")
+        start = time.perf_counter()
+        fieldGrid = FieldGrid.fromBoundary(boundary, gridSmall, gridLarge, engine, extent)
+        boundaryTime = time.perf_counter() - start
+    else:
+        xmin, ymax, size, rows, cols = cached['grid'].tolist()
+        fieldGrid = FieldGrid(CellGrid(xmin, ymax, size, int(rows), int(cols)), cached['inside'], cached['edge'],
+                              gridLarge, engine)
+
+    digests = polygonDigests(weeds)
+    boxes = polygonBoxes(weeds)
+    windows = fieldGrid.grid.cellWindows(boxes)
+    outputKey = repr((mergeStrips, tuple(color)))
+
+    if cached is None:
+        start = time.perf_counter()
+        weedy = fieldGrid.weedMask(weeds)
+        logClassification(fieldGrid, weeds, boundaryTime, time.perf_counter() - start, log)
+        dirty = np.ones(fieldGrid.bandCount, dtype=bool)
+    else:
+        # reclassify the cells around weed polygons that are new or gone
+        weedy = cached['weedy'].copy()
+        oldDigests = cached['weedDigests']
+        changed = np.concatenate([cached['weedWindows'][~np.isin(oldDigests, digests)],
+                                  windows[~np.isin(digests, oldDigests)]])
+        start = time.perf_counter()
+        dirty = np.zeros(fieldGrid.bandCount, dtype=bool)
+        index = BoxIndex(boxes) if len(changed) else None
+        for row0, row1, col0, col1 in changed.tolist():
+            if row1 <= row0 or col1 <= col0:
+                continue
+            candidates = index.candidates(*fieldGrid.grid.windowExtent(row0, row1, col0, col1))
+            weedy[row0:row1, col0:col1] = fieldGrid.weedMask([weeds[i] for i in candidates.tolist()],
+                                                             (row0, row1, col0, col1))
+            dirty[row0 // fieldGrid.bandRows:(row1 - 1) // fieldGrid.bandRows + 1] = True
+        log("{} changed weed polygons reclassified in {:.2f} s, {} of {} bands to recalculate".format(
+            len(changed), time.perf_counter() - start, int(dirty.sum()), fieldGrid.bandCount))
+        if not _outputUnchanged(cached, path, outputKey):
+            log("{} differs from the last run, writing all bands".format(path))
+            dirty[:] = True
+
+    # the writer writes a new file, the unchanged bands are copied from the previous one
+    offsets = np.zeros(fieldGrid.bandCount + 1, dtype=np.int64)
+    patches = np.zeros(fieldGrid.bandCount, dtype=np.int64)
+    vertices = np.zeros(fieldGrid.bandCount, dtype=np.int64)
+    previous = open(path, 'rb') if not dirty.all() else None
+    try:
+        with SectionsWriter(path, color) as writer:
+            for band in range(fieldGrid.bandCount):
+                patchCount, vertexCount = writer.patchCount, writer.vertexCount
+                if dirty[band] or onCells is not None:
+                    rects = fieldGrid.bandCells(weedy, band)
+                    if onCells is not None:
+                        onCells(rects)
+                if dirty[band]:
+                    writeCells(writer, rects, mergeStrips, cellCorners)
+                else:
+                    start, end = cached['bandOffsets'][band:band + 2].tolist()
+                    previous.seek(start)
+                    writer.writeRaw(previous.read(end - start), int(cached['bandPatches'][band]),
+                                    int(cached['bandVertices'][band]))
+                offsets[band + 1] = writer.offset
+                patches[band] = writer.patchCount - patchCount
+                vertices[band] = writer.vertexCount - vertexCount
+    finally:
+        if previous is not None:
+            previous.close()
+
+    stat = os.stat(path)
+    grid = fieldGrid.grid
+    cache.save(grid=np.array([grid.xmin, grid.ymax, grid.size, grid.rows, grid.cols], dtype=float),
+               inside=fieldGrid.inside, edge=fieldGrid.edge, weedy=weedy, weedDigests=digests, weedWindows=windows,
+               bandOffsets=offsets, bandPatches=patches, bandVertices=vertices, outputKey=np.array(outputKey),
+               outputPath=np.array(os.path.abspath(path)), outputSize=np.array(stat.st_size),
+               outputMtime=np.array(stat.st_mtime_ns))
+    log("Wrote {} patches with {} vertices to {}, {} of {} bands recalculated".format(
+        writer.patchCount, writer.vertexCount, path, int(dirty.sum()), fieldGrid.bandCount))
+    return {'patches': writer.patchCount, 'vertices': writer.vertexCount,
+            'bands': fieldGrid.bandCount, 'rewrittenBands': int(dirty.sum())}
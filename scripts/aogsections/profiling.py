@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Opt-in profiling of the steps of a section calculation: wall and CPU time, feature and
+   vertex counts and peak memory per step, as text table or JSON
+"""
+
+import datetime
+import json
+import sys
+import time
+
+
+def peakMemory():
+    """
+    Returns the peak resident memory of the process in bytes, or None if it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] \
+                + [(name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                    'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                    ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+def polygonVertexCount(polygons):
+    """
+    Returns the number of vertices of polygons given as lists of rings
+    """
+    return sum(len(ring) for rings in polygons for ring in rings)
+
+
+class StepProfiler:
+    """
+    Records the steps of a run; start begins a step (and ends the previous one), count adds
+    feature and vertex counts to the current step. A disabled profiler records nothing, so
+    the calls can stay in the code; check enabled before counting something expensive
+    """
+
+    COUNTS = ('inputFeatures', 'inputVertices', 'outputFeatures', 'outputVertices')
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.steps = []
+        self.current = None
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        self.stop()
+        self.current = {'step': name, 'wall': time.perf_counter(), 'cpu': time.process_time(),
+                        'peakBefore': peakMemory()}
+
+    def count(self, **counts):
+        if self.current is None:
+            return
+        for name, value in counts.items():
+            if name not in self.COUNTS:
+                raise ValueError("Unknown count {}".format(name))
+            if value is not None:
+                self.current[name] = self.current.get(name, 0) + int(value)
+
+    def stop(self):
+        if self.current is None:
+            return
+        step = self.current
+        self.current = None
+        step['wall'] = time.perf_counter() - step['wall']
+        step['cpu'] = time.process_time() - step['cpu']
+        peak = peakMemory()
+        step['peakMB'] = peak / 2 ** 20 if peak is not None else None
+        step['peakGrowthMB'] = (peak - step.pop('peakBefore')) / 2 ** 20 if peak is not None else None
+        self.steps.append(step)
+
+    def formatTable(self):
+        """
+        Returns the recorded steps as text table; peak is the peak memory of the process after
+        the step and growth the increase of that peak during the step
+        """
+        self.stop()
+        columns = [('Step', 'step', '{}'), ('Wall s', 'wall', '{:.3f}'), ('CPU s', 'cpu', '{:.3f}'),
+                   ('In feat.', 'inputFeatures', '{}'), ('In vert.', 'inputVertices', '{}'),
+                   ('Out feat.', 'outputFeatures', '{}'), ('Out vert.', 'outputVertices', '{}'),
+                   ('Peak MB', 'peakMB', '{:.0f}'), ('Growth MB', 'peakGrowthMB', '{:.0f}')]
+        total = {'step': 'Total', 'wall': sum(step['wall'] for step in self.steps),
+                 'cpu': sum(step['cpu'] for step in self.steps)}
+        rows = [[title for title, _, _ in columns]]
+        for step in self.steps + [total]:
+            rows.append([pattern.format(step[key]) if step.get(key) is not None else '-'
+                         for _, key, pattern in columns])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        return '\n'.join('  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                                   for i, (cell, width) in enumerate(zip(row, widths))) for row in rows)
+
+    def toDict(self):
+        self.stop()
+        return {'started': self.started, 'python': sys.version.split()[0], 'steps': self.steps,
+                'wall': sum(step['wall'] for step in self.steps), 'cpu': sum(step['cpu'] for step in self.steps)}
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.toDict(), file, indent=1)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Reader and writer for AOG Sections.txt files: every patch is a line with the number of
+   following lines, the color line and the vertices (easting,northing,0) of a triangle strip
+"""
+
+import os
+from itertools import repeat
+
+import numpy as np
+
+DEFAULT_COLOR = (27, 151, 160)
+# Number of cells formatted per batch and size of the file buffer
+CHUNK_SIZE = 50000
+BUFFER_SIZE = 1024 * 1024
+# Sections.txt files larger than this are memory mapped and parsed in chunks of READ_CHUNK_SIZE
+MMAP_SIZE = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024 * 1024
+# AOG draws a patch as triangle strip: top left, bottom left, top right, bottom right
+# (vertex 0, 3, 1 and 2 of a grid cell)
+STRIP_ORDER = [0, 3, 1, 2]
+# Maximum number of cells merged into one strip patch; AOG itself starts a new patch
+# after about 60 vertices
+MAX_STRIP_CELLS = 30
+
+
+def rectCorners(rects):
+    """
+    Returns the corners of cells given as array of left, top, right, bottom as array of
+    shape (n, 4, 2), in the vertex order of native:creategrid (top left, top right,
+    bottom right, bottom left)
+    """
+    left, top, right, bottom = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+    return np.stack([np.column_stack([left, top]), np.column_stack([right, top]),
+                     np.column_stack([right, bottom]), np.column_stack([left, bottom])], axis=1)
+
+
+def stripStarts(rects, mergeStrips=True, maxCells=MAX_STRIP_CELLS):
+    """
+    Marks the cells that start a new strip patch; rects holds left, top, right, bottom
+    of cells ordered row by row. A cell continues the strip of its predecessor if it has
+    the same top and bottom and its left edge is the right edge of the predecessor
+    """
+    starts = np.ones(len(rects), dtype=bool)
+    if not mergeStrips or len(rects) < 2:
+        return starts
+    tolerance = 1e-6 * np.abs(rects[1:, 2] - rects[1:, 0])
+    starts[1:] = ~((np.abs(rects[1:, 0] - rects[:-1, 2]) <= tolerance)
+                   & (np.abs(rects[1:, 1] - rects[:-1, 1]) <= tolerance)
+                   & (np.abs(rects[1:, 3] - rects[:-1, 3]) <= tolerance))
+    # split strips longer than maxCells
+    stripIndex = np.cumsum(starts) - 1
+    position = np.arange(len(rects)) - np.flatnonzero(starts)[stripIndex]
+    return starts | (position % maxCells == 0)
+
+
+def formatColor(color):
+    return '{},{},{}\n'.format(*color)
+
+
+def formatSectionPatches(corners, starts, colorLine):
+    """
+    Formats cells as AOG section patches; corners is an array of shape (n, 4, 2) with
+    easting / northing of the first four vertices of each cell, starts marks the cells
+    that start a new patch (see stripStarts)
+    """
+    # a strip starts with the left edge of its first cell, followed by the right edge of every cell;
+    # the left edge of a following cell is the right edge of its predecessor
+    vertices = corners[:, STRIP_ORDER, :]
+    keep = np.ones(vertices.shape[:2], dtype=bool)
+    keep[~starts, :2] = False
+    vertices = vertices[keep]
+    lines = list(map('{},{},0\n'.format, map(round, vertices[:, 0].tolist(), repeat(3)),
+                     map(round, vertices[:, 1].tolist(), repeat(3))))
+
+    # every patch is the number of lines (color and vertices) and the color, followed by its vertices
+    firstCells = np.flatnonzero(starts)
+    stripCells = np.diff(np.append(firstCells, len(starts)))
+    headers = ['{}\n'.format(2 * cells + 3) + colorLine for cells in stripCells.tolist()]
+    patches = np.empty(len(headers) + len(lines), dtype=object)
+    # the header of strip i is preceded by i headers and the vertices of the previous strips
+    headerPositions = np.arange(len(headers)) + 2 * firstCells + 2 * np.arange(len(headers))
+    isHeader = np.zeros(len(patches), dtype=bool)
+    isHeader[headerPositions] = True
+    patches[isHeader] = headers
+    patches[~isHeader] = lines
+    return ''.join(patches.tolist())
+
+
+class SectionsWriter:
+    """
+    Writes cells as patches to an AOG Sections.txt file
+    """
+
+    def __init__(self, path, color=DEFAULT_COLOR):
+        self.path = path
+        self.colorLine = formatColor(color)
+        self.patchCount = 0
+        self.vertexCount = 0
+        # bytes written so far, to locate parts of the file in later runs
+        self.offset = 0
+        self.file = None
+        self.aborted = False
+
+    def __enter__(self):
+        # written to a temporary file first, so the previous file can be read while writing
+        # and is only replaced by a complete file
+        self.file = open(self.path + '.tmp', "w", buffering=BUFFER_SIZE)
+        return self
+
+    def __exit__(self, excType, *args):
+        self.file.close()
+        if excType is None and not self.aborted:
+            os.replace(self.path + '.tmp', self.path)
+        else:
+            os.remove(self.path + '.tmp')
+
+    def abort(self):
+        """
+        Discards the written patches, the previous file is kept
+        """
+        self.aborted = True
+
+    def writeCells(self, corners, starts):
+        """
+        Writes cells with easting / northing corners as returned by rectCorners
+        """
+        text = formatSectionPatches(corners, starts, self.colorLine)
+        self.file.write(text)
+        # text mode writes os.linesep for every newline
+        self.offset = self.offset + len(text) + text.count('\n') * (len(os.linesep) - 1)
+        self.patchCount = self.patchCount + int(starts.sum())
+        self.vertexCount = self.vertexCount + 2 * len(corners) + 2 * int(starts.sum())
+
+    def writeRaw(self, data, patchCount, vertexCount):
+        """
+        Writes already formatted patches, e.g. copied from a previous Sections.txt
+        """
+        self.file.flush()
+        self.file.buffer.write(data)
+        self.offset = self.offset + len(data)
+        self.patchCount = self.patchCount + patchCount
+        self.vertexCount = self.vertexCount + vertexCount
+
+    def writePatches(self, patches):
+        """
+        Copies the patches of a Sections.txt file read with readSections unchanged
+        """
+        with open(patches.path, 'rb') as file:
+            file.seek(patches.dataStart)
+            remaining = patches.dataEnd - patches.dataStart
+            last = b'\n'
+            while remaining > 0:
+                data = file.read(min(BUFFER_SIZE, remaining))
+                if not data:
+                    break
+                self.writeRaw(data, 0, 0)
+                remaining = remaining - len(data)
+                last = data[-1:]
+        if last != b'\n':
+            self.writeRaw(os.linesep.encode(), 0, 0)
+        self.patchCount = self.patchCount + patches.patchCount
+        self.vertexCount = self.vertexCount + len(patches.vertices)
+
+
+class SectionPatches:
+    """
+    Patches of a Sections.txt file: number of lines, color and first vertex of every patch
+    and all vertices (easting, northing) as arrays
+    """
+
+    def __init__(self, path, counts, colors, vertices, dataStart=0, dataEnd=0):
+        self.path = path
+        self.counts = counts
+        self.colors = colors
+        self.vertices = vertices
+        self.firstVertices = np.cumsum(counts - 1) - (counts - 1)
+        # bytes of the file with patches
+        self.dataStart = dataStart
+        self.dataEnd = dataEnd
+
+    @property
+    def patchCount(self):
+        return len(self.counts)
+
+    def triangles(self):
+        """
+        Returns the triangles of all triangle strip patches as array of shape (n, 3, 2)
+        """
+        vertexCounts = self.counts - 1
+        triangleCounts = np.maximum(vertexCounts - 2, 0)
+        first = np.repeat(self.firstVertices, triangleCounts) \
+            + np.arange(triangleCounts.sum()) - np.repeat(np.cumsum(triangleCounts) - triangleCounts, triangleCounts)
+        return self.vertices[first[:, None] + np.arange(3)]
+
+
+def _parseChunk(chunk):
+    """
+    Parses a chunk of complete lines; returns the offset of every non empty line in the chunk,
+    its number of commas and all numbers of the chunk
+    """
+    newlines = np.flatnonzero(chunk == 10)
+    lineStarts = np.concatenate([[0], newlines + 1])
+    if lineStarts[-1] == len(chunk):
+        lineStarts = lineStarts[:-1]
+    # every line runs from its start to the next one (including its newline), so no segment is empty
+    nonEmpty = np.logical_or.reduceat((chunk >= 48) & (chunk <= 57), lineStarts)
+    # the line of a comma is the number of newlines before it
+    commas = np.bincount(np.searchsorted(newlines, np.flatnonzero(chunk == 44)),
+                         minlength=len(lineStarts))[:len(lineStarts)]
+    numbers = np.fromstring(chunk.tobytes().translate(_NUMBER_TABLE).decode('ascii', 'replace'), sep=' ')
+    return lineStarts[nonEmpty], commas[nonEmpty], numbers
+
+
+# commas and carriage returns become spaces for the number parser
+_NUMBER_TABLE = bytes.maketrans(b',\r', b'  ')
+
+
+def readSections(path):
+    """
+    Reads an AOG Sections.txt file into a SectionPatches object; the file is parsed with
+    NumPy in large chunks (memory mapped for large files): count lines are the lines without
+    a comma, color and vertex lines have three numbers
+    """
+    size = os.path.getsize(path)
+    empty = SectionPatches(path, np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.int64), np.empty((0, 2)))
+    if size == 0:
+        return empty
+    data = np.memmap(path, dtype=np.uint8, mode='r') if size > MMAP_SIZE else np.fromfile(path, dtype=np.uint8)
+    lineStarts = []
+    commas = []
+    numbers = []
+    position = 0
+    while position < size:
+        end = min(position + READ_CHUNK_SIZE, size)
+        if end < size:
+            # cut the chunk after its last newline
+            newlines = np.flatnonzero(data[position:end] == 10)
+            if not len(newlines):
+                raise ValueError("{} is not a Sections.txt file, line too long at byte {}".format(path, position))
+            end = position + int(newlines[-1]) + 1
+        starts, chunkCommas, chunkNumbers = _parseChunk(np.asarray(data[position:end]))
+        lineStarts.append(starts + position)
+        commas.append(chunkCommas)
+        numbers.append(chunkNumbers)
+        position = end
+    del data
+    lineStarts = np.concatenate(lineStarts)
+    commas = np.concatenate(commas)
+    numbers = np.concatenate(numbers)
+    if not len(lineStarts):
+        return empty
+
+    # numbers per line: 1 on count lines, 3 on color and vertex lines
+    numberCounts = commas + 1
+    if numberCounts.sum() != len(numbers) or not np.isin(commas, (0, 2)).all():
+        raise ValueError("{} is not a Sections.txt file, unexpected numbers in a line".format(path))
+    firstNumbers = np.cumsum(numberCounts) - numberCounts
+    countLines = np.flatnonzero(commas == 0)
+    counts = numbers[firstNumbers[countLines]].astype(np.int64)
+    following = np.append(countLines[1:], len(lineStarts))
+    if not len(countLines) or countLines[0] != 0 or (counts < 1).any() \
+            or not np.array_equal(countLines + counts + 1, following):
+        raise ValueError("{} is not a Sections.txt file, patch line counts do not match".format(path))
+
+    colorLines = countLines + 1
+    colors = numbers[firstNumbers[colorLines][:, None] + np.arange(3)].astype(np.int64)
+    vertexLines = np.ones(len(lineStarts), dtype=bool)
+    vertexLines[countLines] = False
+    vertexLines[colorLines] = False
+    vertices = numbers[firstNumbers[vertexLines][:, None] + np.arange(2)]
+    return SectionPatches(path, counts, colors, vertices, int(lineStarts[0]), size)
+
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Uniform grid hash over the bounding boxes of polygons, to find the few weed polygons
+   near a cell or a window of cells without testing all of them
+"""
+
+import numpy as np
+
+from .geometry import polygonEdges
+
+
+def polygonBoxes(polygons):
+    """
+    Returns the bounding boxes of the polygons as array of shape (n, 4) with xmin, ymin, xmax, ymax;
+    polygons without a valid ring get an empty box (nan)
+    """
+    boxes = np.full((len(polygons), 4), np.nan)
+    edges, ids = polygonEdges(polygons)
+    if not len(edges):
+        return boxes
+    # edges of a polygon follow each other, reduce each run of ids
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    x = np.minimum(edges[:, 0], edges[:, 2]), np.maximum(edges[:, 0], edges[:, 2])
+    y = np.minimum(edges[:, 1], edges[:, 3]), np.maximum(edges[:, 1], edges[:, 3])
+    boxes[ids[starts]] = np.stack([np.minimum.reduceat(x[0], starts), np.minimum.reduceat(y[0], starts),
+                                   np.maximum.reduceat(x[1], starts), np.maximum.reduceat(y[1], starts)], axis=1)
+    return boxes
+
+
+class BoxIndex:
+    """
+    Grid hash of boxes xmin, ymin, xmax, ymax: every box is registered in all buckets it
+    covers, a query only looks at the buckets of the query box
+    """
+
+    def __init__(self, boxes, bucketSize=None):
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        valid = np.flatnonzero(~np.isnan(self.boxes).any(axis=1))
+        if not len(valid):
+            self.origin = np.zeros(2)
+            self.bucketSize = 1.0
+            self.keys = np.empty(0, dtype=np.int64)
+            self.items = np.empty(0, dtype=np.int64)
+            self.shape = (1, 1)
+            return
+        boxes = self.boxes[valid]
+        self.origin = boxes[:, :2].min(axis=0)
+        extent = boxes[:, 2:].max(axis=0) - self.origin
+        if bucketSize is None:
+            # about one box per bucket, but buckets not smaller than a typical box
+            typical = np.median(np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]))
+            bucketSize = max(np.sqrt(max(extent[0] * extent[1], 0) / len(boxes)), typical)
+        self.bucketSize = float(bucketSize) if bucketSize > 0 else 1.0
+        self.shape = tuple(int(n) for n in np.floor(extent / self.bucketSize) + 1)
+
+        lo = self.bucketOf(boxes[:, :2])
+        hi = self.bucketOf(boxes[:, 2:])
+        cols = hi[:, 0] - lo[:, 0] + 1
+        rows = hi[:, 1] - lo[:, 1] + 1
+        counts = cols * rows
+        item = np.repeat(np.arange(len(boxes)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        bx = lo[item, 0] + k % cols[item]
+        by = lo[item, 1] + k // cols[item]
+        keys = by * self.shape[0] + bx
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.items = valid[item[order]]
+
+    def bucketOf(self, points):
+        buckets = np.floor((points - self.origin) / self.bucketSize).astype(np.int64)
+        return np.clip(buckets, 0, np.array(self.shape) - 1)
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        """
+        Returns the sorted indices of the boxes that intersect the query box
+        """
+        if not len(self.items):
+            return np.empty(0, dtype=np.int64)
+        (x0, y0), (x1, y1) = self.bucketOf(np.array([[xmin, ymin], [xmax, ymax]]))
+        keys = (np.arange(y0, y1 + 1)[:, None] * self.shape[0] + np.arange(x0, x1 + 1)).ravel()
+        first = np.searchsorted(self.keys, keys)
+        last = np.searchsorted(self.keys, keys, side='right')
+        if not (last > first).any():
+            return np.empty(0, dtype=np.int64)
+        items = np.unique(np.concatenate([self.items[f:l] for f, l in zip(first.tolist(), last.tolist())]))
+        boxes = self.boxes[items]
+        return items[(boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Tiled section calculation for very large fields at fine grid sizes: the field extent is
+   split into square tiles aligned to the large grid, every tile is classified on its own
+   and its patches are streamed to Sections.txt, so memory depends on the tile size only
+"""
+
+import math
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .geometry import CellGrid, polygonEdges, rasterizePolygons, traceEdges, weedCells
+from .pipeline import ENGINE_QUADTREE, ENGINE_RASTER_MASK, FieldGrid, _noLog, checkGridSizes, polygonBounds, \
+    writeCells
+from .sections import DEFAULT_COLOR, SectionsWriter, rectCorners
+from .spatialindex import BoxIndex, polygonBoxes
+from .weedraster import WeedRaster
+
+# tile size in meters if none is given
+DEFAULT_TILE_SIZE = 200.0
+
+
+def tileCellCount(tileSize, gridSmall, gridLarge=None, engine=ENGINE_RASTER_MASK):
+    """
+    Returns the edge length of a tile in small cells: tileSize rounded up to a multiple of the
+    large grid, or to a power of two multiple of the small grid for the quadtree engine
+    """
+    cells = max(int(math.ceil(tileSize / gridSmall - 1e-9)), 1)
+    if engine == ENGINE_QUADTREE:
+        return 2 ** int(math.ceil(math.log2(cells)))
+    factor = int(round(gridLarge / gridSmall))
+    return -(-cells // factor) * factor
+
+
+class TiledField:
+    """
+    Field boundary and weeds prepared for the classification of single tiles; only the
+    boundary edges and the weed polygons near a tile are rasterized for it (or the blocks of
+    a WeedRaster covering the tile are read)
+    """
+
+    def __init__(self, boundary, weeds, gridSmall, gridLarge=None, engine=ENGINE_RASTER_MASK,
+                 tileSize=DEFAULT_TILE_SIZE, extent=None):
+        if not boundary:
+            raise ValueError("No field boundary polygon")
+        checkGridSizes(gridSmall, gridLarge if engine == ENGINE_RASTER_MASK else None)
+        xmin, ymin, xmax, ymax = extent if extent is not None else polygonBounds(boundary)
+        self.grid = CellGrid.fromExtent(xmin, ymin, xmax, ymax, gridSmall)
+        self.gridLarge = gridLarge
+        self.engine = engine
+        self.cellsPerTile = tileCellCount(tileSize, gridSmall, gridLarge, engine)
+        self.tileRows = -(-self.grid.rows // self.cellsPerTile)
+        self.tileCols = -(-self.grid.cols // self.cellsPerTile)
+        self.boundaryEdges, self.boundaryIds = polygonEdges(boundary)
+        self.weeds = weeds
+        self.weedIndex = None if isinstance(weeds, WeedRaster) else BoxIndex(polygonBoxes(weeds))
+
+    def tileWindows(self):
+        """
+        Returns row0, row1, col0, col1 of all tiles, row by row; tiles at the right and bottom
+        border reach beyond the grid, so that every tile has the same size
+        """
+        size = self.cellsPerTile
+        return [(row * size, (row + 1) * size, col * size, (col + 1) * size)
+                for row in range(self.tileRows) for col in range(self.tileCols)]
+
+    def tileCells(self, window):
+        """
+        Returns left, top, right, bottom of the applied cells of a tile and the number of
+        cells on the field boundary
+        """
+        grid = self.grid.window(*window)
+        xmin, ymin, xmax, ymax = self.grid.windowExtent(*window)
+        # the scanline fill needs all boundary edges crossing the rows of the tile, also left of it
+        rows = (np.maximum(self.boundaryEdges[:, 1], self.boundaryEdges[:, 3]) >= ymin) \
+            & (np.minimum(self.boundaryEdges[:, 1], self.boundaryEdges[:, 3]) <= ymax)
+        if not rows.any():
+            return np.empty((0, 4)), 0
+        edge = traceEdges(self.boundaryEdges[rows], grid)
+        inside = rasterizePolygons(self.boundaryEdges[rows], self.boundaryIds[rows], grid) & ~edge
+        if not inside.any() and not edge.any():
+            return np.empty((0, 4)), 0
+        if self.weedIndex is None:
+            # only the raster blocks of the tile are read
+            weedy = self.weeds.cellMask(grid)
+        else:
+            candidates = self.weedIndex.candidates(xmin, ymin, xmax, ymax)
+            weedy = weedCells([self.weeds[i] for i in candidates.tolist()], grid)
+        fieldGrid = FieldGrid(grid, inside, edge, self.gridLarge, self.engine)
+        cells = fieldGrid.cells(weedy)
+        return cells, int(edge.sum())
+
+
+# field of the worker processes, set once per process by _initWorker
+_workerField = None
+
+
+def _initWorker(field):
+    global _workerField
+    _workerField = field
+
+
+def _workerTileCells(window):
+    return _workerField.tileCells(window)
+
+
+def iterTileCells(field, workers=1):
+    """
+    Yields the cells of all tiles in tile order (see TiledField.tileCells); with more than one
+    worker the tiles are classified in worker processes, with at most two tiles per worker
+    waiting to be written
+    """
+    windows = field.tileWindows()
+    if workers <= 1:
+        for window in windows:
+            yield field.tileCells(window)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(field,)) as executor:
+        pending = deque()
+        for window in windows:
+            pending.append(executor.submit(_workerTileCells, window))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def generateTiledSections(boundary, weeds, path, gridSmall=1.0, gridLarge=10.0, engine=ENGINE_RASTER_MASK,
+                          mergeStrips=True, color=DEFAULT_COLOR, tileSize=DEFAULT_TILE_SIZE, workers=1, extent=None,
+                          cellCorners=rectCorners, onCells=None, keepPatches=None, log=_noLog):
+    """
+    Writes Sections.txt at path tile by tile for polygons in grid coordinates. cellCorners converts
+    cells to AOG local corners (default: the grid is in AOG local coordinates); onCells is called
+    with the cells of every tile, e.g. to create an output layer; the patches of keepPatches (see
+    readSections) are copied to the new file first. Strips are not merged across
+    tile borders and quadtree cells are not larger than a tile.
+    Returns a dict with the number of cells, patches, vertices and tiles
+    """
+    start = time.perf_counter()
+    field = TiledField(boundary, weeds, gridSmall, gridLarge if engine == ENGINE_RASTER_MASK else None, engine,
+                       tileSize, extent)
+    log("{} x {} tiles of {} x {} cells".format(field.tileRows, field.tileCols, field.cellsPerTile,
+                                                 field.cellsPerTile))
+    cellCount = 0
+    edgeCount = 0
+    with SectionsWriter(path, color) as writer:
+        if keepPatches is not None:
+            writer.writePatches(keepPatches)
+        for cells, edges in iterTileCells(field, workers):
+            if not len(cells):
+                continue
+            if onCells is not None:
+                onCells(cells)
+            writeCells(writer, cells, mergeStrips, cellCorners)
+            cellCount = cellCount + len(cells)
+            edgeCount = edgeCount + edges
+    log("Wrote {} cells ({} on field boundary) as {} patches with {} vertices to {} in {:.2f} s".format(
+        cellCount, edgeCount, writer.patchCount, writer.vertexCount, path, time.perf_counter() - start))
+    return {'cells': cellCount, 'patches': writer.patchCount, 'vertices': writer.vertexCount,
+            'tiles': field.tileRows * field.tileCols}
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Verification of a Sections.txt against the intended spray area: the triangles of all
+   patches, the field boundary and the weeds are rasterized to a fine pixel grid (scanline
+   fill, band by band), then weed area marked as applied and clean area left unapplied are
+   counted
+"""
+
+import time
+
+import numpy as np
+
+from .geometry import CellGrid, polygonEdges, rasterizePolygons
+from .pipeline import _noLog, polygonBounds
+from .weedraster import WeedRaster
+
+# pixel size in meters
+DEFAULT_RESOLUTION = 0.1
+# pixels rasterized at once, small enough to stay in the CPU cache
+BAND_PIXELS = 2 ** 18
+
+
+class _Bands:
+    """
+    Items (edges or triangles) sorted by the bands of bandRows rows of grid they reach into,
+    so that the items of a band are a slice instead of a test of all items per band
+    """
+
+    def __init__(self, ymin, ymax, grid, bandRows):
+        height = grid.size * bandRows
+        bandCount = -(-grid.rows // bandRows)
+        first = np.clip(np.floor((grid.ymax - ymax) / height), 0, bandCount - 1).astype(np.int64)
+        counts = np.clip(np.floor((grid.ymax - ymin) / height), 0, bandCount - 1).astype(np.int64) - first + 1
+        items = np.repeat(np.arange(len(first)), counts)
+        bands = np.repeat(first, counts) + np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = np.argsort(bands, kind='stable')
+        self.items = items[order]
+        self.starts = np.searchsorted(bands[order], np.arange(bandCount + 1))
+
+    def band(self, index):
+        return self.items[self.starts[index]:self.starts[index + 1]]
+
+
+def _edgeBands(edges, grid, bandRows):
+    return _Bands(np.minimum(edges[:, 1], edges[:, 3]), np.maximum(edges[:, 1], edges[:, 3]), grid, bandRows)
+
+
+def verifySections(patches, boundary, weeds, resolution=DEFAULT_RESOLUTION, log=_noLog):
+    """
+    Compares the patches of a Sections.txt (see readSections) with field boundary and weeds
+    (polygons or a WeedRaster), all in AOG local coordinates; a pixel counts as covered, field
+    or weed if its center is (for a WeedRaster: if a weed pixel touches it).
+    Returns a dict with patch, vertex and triangle count and the areas in square meters of the
+    field, the weeds within it, all covered pixels, weeds covered (wrongly applied), clean field
+    left uncovered and covered outside the field
+    """
+    start = time.perf_counter()
+    if not boundary:
+        raise ValueError("No field boundary polygon")
+    if resolution <= 0:
+        raise ValueError("Resolution must be greater than 0")
+    triangles = patches.triangles()
+    xmin, ymin, xmax, ymax = polygonBounds(boundary)
+    if len(triangles):
+        # patches outside the field are counted as well
+        xmin, ymin = np.minimum([xmin, ymin], patches.vertices.min(axis=0)).tolist()
+        xmax, ymax = np.maximum([xmax, ymax], patches.vertices.max(axis=0)).tolist()
+    grid = CellGrid.fromExtent(xmin, ymin, xmax, ymax, resolution)
+
+    bandRows = max(BAND_PIXELS // grid.cols, 1)
+    triangleBands = _Bands(triangles[:, :, 1].min(axis=1), triangles[:, :, 1].max(axis=1), grid, bandRows)
+    boundaryEdges, boundaryIds = polygonEdges(boundary)
+    boundaryBands = _edgeBands(boundaryEdges, grid, bandRows)
+    weedRaster = isinstance(weeds, WeedRaster)
+    if not weedRaster:
+        weedEdges, weedIds = polygonEdges(weeds)
+        weedBands = _edgeBands(weedEdges, grid, bandRows)
+
+    pixels = dict.fromkeys(('field', 'weeds', 'covered', 'weedCovered', 'uncovered', 'outside'), 0)
+    for index, row0 in enumerate(range(0, grid.rows, bandRows)):
+        band = grid.window(row0, min(row0 + bandRows, grid.rows), 0, grid.cols)
+        edges = boundaryBands.band(index)
+        field = rasterizePolygons(boundaryEdges[edges], boundaryIds[edges], band)
+        bandTriangles = triangles[triangleBands.band(index)]
+        # the three edges of every triangle, each triangle its own polygon
+        triangleEdges = np.concatenate([bandTriangles, bandTriangles[:, [1, 2, 0]]], axis=2).reshape(-1, 4)
+        covered = rasterizePolygons(triangleEdges, np.repeat(np.arange(len(bandTriangles)), 3), band)
+        if weedRaster:
+            weedy = weeds.cellMask(band)
+        else:
+            edges = weedBands.band(index)
+            weedy = rasterizePolygons(weedEdges[edges], weedIds[edges], band)
+        pixels['field'] += int(field.sum())
+        pixels['weeds'] += int((weedy & field).sum())
+        pixels['covered'] += int(covered.sum())
+        pixels['weedCovered'] += int((weedy & covered).sum())
+        pixels['uncovered'] += int((field & ~weedy & ~covered).sum())
+        pixels['outside'] += int((covered & ~field).sum())
+
+    result = {'patches': patches.patchCount, 'vertices': len(patches.vertices), 'triangles': len(triangles),
+              'resolution': resolution, 'pixels': grid.rows * grid.cols}
+    result.update({name + 'Area': count * resolution ** 2 for name, count in pixels.items()})
+    result['seconds'] = time.perf_counter() - start
+    log("Verified {} patches on {} x {} pixels of {} m in {:.2f} s".format(
+        result['patches'], grid.rows, grid.cols, resolution, result['seconds']))
+    return result
+
+
+def formatVerification(result):
+    """
+    Returns the verification result as text lines
+    """
+    field = result['fieldArea'] or 1.0
+    clean = max(result['fieldArea'] - result['weedsArea'], 0.0) or 1.0
+    return '\n'.join([
+        "Patches: {} ({} vertices, {} triangles)".format(result['patches'], result['vertices'], result['triangles']),
+        "Field: {:.1f} m2, weeds within the field: {:.1f} m2 ({:.2%})".format(
+            result['fieldArea'], result['weedsArea'], result['weedsArea'] / field),
+        "Covered by patches: {:.1f} m2, outside the field: {:.1f} m2".format(result['coveredArea'],
+                                                                           result['outsideArea']),
+        "Weed area marked as applied: {:.2f} m2 ({:.2%} of the weeds)".format(
+            result['weedCoveredArea'], result['weedCoveredArea'] / (result['weedsArea'] or 1.0)),
+        "Clean area left unapplied: {:.1f} m2 ({:.2%} of the clean field area)".format(
+            result['uncoveredArea'], result['uncoveredArea'] / clean),
+        "Checked at {} m resolution in {:.2f} s".format(result['resolution'], result['seconds'])])
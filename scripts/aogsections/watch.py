@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Watch mode: keeps StartFix, boundary and boundary classification of every field of an
+   AgOpenGPS Fields folder in memory, polls the weed files and regenerates the Sections.txt
+   of a field within seconds of a change; the state of all fields can be served as JSON
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .batch import findFields, findWeedFile
+from .fieldfiles import readPolygons
+from .localframe import LocalFrame
+from .pipeline import ENGINE_RASTER_MASK, FieldGrid, _noLog, writeCells
+from .sections import DEFAULT_COLOR, SectionsWriter
+from .weedraster import DEFAULT_THRESHOLD, WeedRaster, readWeeds
+
+
+def fileSignature(path):
+    """
+    Returns (modification time in ns, size) of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class WatchedField:
+    """
+    A field folder with its weed file; load reads Field.txt and Field.kml and classifies the
+    grid against the boundary once, generate only reads the weeds and classifies against them
+    """
+
+    def __init__(self, name, fieldDir, weedFile, outputName='Sections.txt'):
+        self.name = name
+        self.fieldDir = fieldDir
+        self.weedFile = weedFile
+        self.outputPath = os.path.join(fieldDir, outputName)
+        self.frame = None
+        self.boundary = None
+        self.fieldGrid = None
+        self.fieldSignature = None
+        self.weedSignature = None
+        self.status = {'field': name, 'weeds': weedFile, 'state': 'waiting', 'runs': 0}
+
+    def fieldFiles(self):
+        return os.path.join(self.fieldDir, 'Field.txt'), os.path.join(self.fieldDir, 'Field.kml')
+
+    def load(self, options):
+        fieldFile, boundaryFile = self.fieldFiles()
+        self.fieldSignature = tuple(fileSignature(path) for path in (fieldFile, boundaryFile))
+        self.frame = LocalFrame.fromFieldFile(fieldFile)
+        self.boundary = self.frame.polygonsToLocal(readPolygons(boundaryFile))
+        self.fieldGrid = None
+        if options.get('tileSize') is None:
+            self.fieldGrid = FieldGrid.fromBoundary(self.boundary, options['gridSmall'], options['gridLarge'],
+                                                    options['engine'])
+
+    def isStale(self):
+        """
+        Checks whether the field needs to be generated: its weed file or field files changed
+        since the last run, or Sections.txt is older than the weed file (on the first poll)
+        """
+        if self.weedSignature is None:
+            weeds = fileSignature(self.weedFile)
+            output = fileSignature(self.outputPath)
+            return weeds is not None and (output is None or output[0] < weeds[0])
+        return fileSignature(self.weedFile) != self.weedSignature \
+            or tuple(fileSignature(path) for path in self.fieldFiles()) != self.fieldSignature
+
+    def generate(self, options, weedThreshold=DEFAULT_THRESHOLD, log=_noLog):
+        """
+        Writes Sections.txt for the current weed file and returns the result dict
+        """
+        start = time.perf_counter()
+        self.weedSignature = fileSignature(self.weedFile)
+        if self.frame is None or tuple(fileSignature(path) for path in self.fieldFiles()) != self.fieldSignature:
+            self.load(options)
+        weeds = readWeeds(self.weedFile, self.frame, weedThreshold)
+        if not isinstance(weeds, WeedRaster):
+            weeds = self.frame.polygonsToLocal(weeds)
+        if self.fieldGrid is None:
+            # imported here, tiling builds on the pipeline
+            from .tiling import generateTiledSections
+            stats = generateTiledSections(self.boundary, weeds, self.outputPath, options['gridSmall'],
+                                          options['gridLarge'], options['engine'], options['mergeStrips'],
+                                          options['color'], options['tileSize'], log=log)
+        else:
+            cells = self.fieldGrid.cells(self.fieldGrid.weedMask(weeds))
+            with SectionsWriter(self.outputPath, options['color']) as writer:
+                writeCells(writer, cells, options['mergeStrips'])
+            stats = {'cells': len(cells), 'patches': writer.patchCount, 'vertices': writer.vertexCount}
+        return dict(stats, seconds=time.perf_counter() - start)
+
+
+class FieldWatcher:
+    """
+    Polls the fields of fieldsRoot and their weed files (see batch.findWeedFile); a field is
+    regenerated when its weed file has not changed for settle seconds, so files that are still
+    being written are not read
+    """
+
+    def __init__(self, fieldsRoot, weedsDir=None, mapping=None, outputName='Sections.txt', gridSmall=1.0,
+                 gridLarge=10.0, engine=ENGINE_RASTER_MASK, mergeStrips=True, color=DEFAULT_COLOR, tileSize=None,
+                 weedThreshold=DEFAULT_THRESHOLD, settle=0.5, log=print):
+        self.fieldsRoot = fieldsRoot
+        self.weedsDir = weedsDir
+        self.mapping = mapping
+        self.outputName = outputName
+        self.options = {'gridSmall': gridSmall, 'gridLarge': gridLarge, 'engine': engine, 'mergeStrips': mergeStrips,
+                        'color': color, 'tileSize': tileSize}
+        self.weedThreshold = weedThreshold
+        self.settle = settle
+        self.log = log
+        self.fields = {}
+        self.lock = threading.Lock()
+
+    def scan(self):
+        """
+        Updates the watched fields from the Fields folder; fields without weed file are not watched
+        """
+        found = {}
+        for name in findFields(self.fieldsRoot):
+            weedFile = findWeedFile(name, self.weedsDir, self.mapping)
+            if weedFile is None:
+                continue
+            field = self.fields.get(name)
+            if field is None or field.weedFile != weedFile:
+                field = WatchedField(name, os.path.join(self.fieldsRoot, name), weedFile, self.outputName)
+                self.log("Watching {} with weeds {}".format(name, weedFile))
+                try:
+                    field.load(self.options)
+                except Exception as e:
+                    # loaded again with the next change of the field files
+                    field.status.update(state='failed', error="{}: {}".format(type(e).__name__, e))
+                    self.log("{}: failed, {}".format(name, field.status['error']))
+            found[name] = field
+        with self.lock:
+            self.fields = found
+
+    def poll(self):
+        """
+        Regenerates all fields with changed files and returns their names
+        """
+        self.scan()
+        regenerated = []
+        for field in list(self.fields.values()):
+            if not field.isStale():
+                continue
+            signature = fileSignature(field.weedFile)
+            if signature is None or time.time() - signature[0] / 1e9 < self.settle:
+                continue
+            self.regenerate(field)
+            regenerated.append(field.name)
+        return regenerated
+
+    def regenerate(self, field):
+        status = {'field': field.name, 'weeds': field.weedFile, 'runs': field.status['runs'] + 1,
+                  'generated': datetime.datetime.now().isoformat(timespec='seconds')}
+        try:
+            stats = field.generate(self.options, self.weedThreshold)
+        except Exception as e:
+            # keep watching, the next change of the files may fix it
+            status.update(state='failed', error="{}: {}".format(type(e).__name__, e))
+            self.log("{}: failed, {}".format(field.name, status['error']))
+        else:
+            # latency from the last change of the weed file to the written Sections.txt
+            status.update(stats, state='ok', latency=time.time() - field.weedSignature[0] / 1e9)
+            self.log("{}: {} patches in {:.2f} s, {:.2f} s after the change of {}".format(
+                field.name, stats['patches'], stats['seconds'], status['latency'],
+                os.path.basename(field.weedFile)))
+        with self.lock:
+            field.status = status
+
+    def status(self):
+        """
+        Returns the state of all fields, e.g. for the status server
+        """
+        with self.lock:
+            fields = [dict(field.status) for _, field in sorted(self.fields.items())]
+        return {'fieldsRoot': self.fieldsRoot, 'fields': fields}
+
+    def run(self, interval=1.0, stop=None):
+        """
+        Polls every interval seconds until stop (a threading.Event) is set
+        """
+        stop = stop or threading.Event()
+        self.log("Watching {} every {} s".format(self.fieldsRoot, interval))
+        while not stop.is_set():
+            started = time.perf_counter()
+            self.poll()
+            stop.wait(max(interval - (time.perf_counter() - started), 0))
+
+
+def serveStatus(watcher, port, host='127.0.0.1'):
+    """
+    Serves the state of the watched fields as JSON on http://host:port/ in a background thread;
+    returns the server (call shutdown to stop it)
+    """
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(watcher.status(), indent=1).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
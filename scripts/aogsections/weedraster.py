@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Weed detection rasters (e.g. a weed probability GeoTIFF) as weed input: the raster is read
+   block by block for the window of a grid, pixels at or above a threshold are aggregated per
+   cell, so the raster is never polygonized nor read into memory as a whole.
+   Needs GDAL (Python package osgeo, part of every QGIS installation)
+"""
+
+import math
+import os
+
+import numpy as np
+
+from .fieldfiles import readPolygons
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = None
+    osr = None
+
+# file types read as weed raster by readWeeds
+RASTER_EXTENSIONS = ('.tif', '.tiff')
+DEFAULT_THRESHOLD = 0.5
+# pixels read at once, rounded to whole block rows of the raster
+READ_PIXELS = 2 ** 22
+
+
+def _transformPoints(transform, x, y):
+    if transform is None:
+        return x, y
+    points = np.array(transform.TransformPoints(np.column_stack([x, y]).tolist()), dtype=float).reshape(-1, 3)
+    return points[:, 0], points[:, 1]
+
+
+class WeedRaster:
+    """
+    Raster band with weed probabilities (or any value that is high on weeds). The grid is in
+    the AOG local coordinates of frame, in the CRS gridCrs (WKT) or, if neither is given, in
+    the CRS of the raster. The raster is opened again after pickling, so it can be passed to
+    worker processes
+    """
+
+    def __init__(self, path, threshold=DEFAULT_THRESHOLD, band=1, frame=None, gridCrs=None):
+        if gdal is None:
+            raise ValueError("Reading weed rasters needs GDAL (Python package osgeo)")
+        self.path = path
+        self.threshold = threshold
+        self.band = band
+        self.frame = frame
+        self.gridCrs = gridCrs
+        self._open()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ('_dataset', '_band', '_toGrid', '_toRaster'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __str__(self):
+        return "weed raster {} (threshold {})".format(os.path.basename(self.path), self.threshold)
+
+    def _open(self):
+        self._dataset = gdal.Open(self.path)
+        if self._dataset is None:
+            raise ValueError("Can not open weed raster {}".format(self.path))
+        if not 1 <= self.band <= self._dataset.RasterCount:
+            raise ValueError("Weed raster {} has no band {}".format(self.path, self.band))
+        self._band = self._dataset.GetRasterBand(self.band)
+        self.geoTransform = self._dataset.GetGeoTransform()
+        self.inverseTransform = gdal.InvGeoTransform(self.geoTransform)
+        if self.inverseTransform is None:
+            raise ValueError("Weed raster {} has no valid geotransform".format(self.path))
+        self.width = self._dataset.RasterXSize
+        self.height = self._dataset.RasterYSize
+        self.nodata = self._band.GetNoDataValue()
+        self.blockRows = self._band.GetBlockSize()[1]
+
+        self._toGrid = self._toRaster = None
+        if self.frame is None and self.gridCrs is None:
+            return
+        wkt = self._dataset.GetProjection()
+        if not wkt:
+            raise ValueError("Weed raster {} has no CRS".format(self.path))
+        rasterCrs = osr.SpatialReference(wkt=wkt)
+        gridCrs = osr.SpatialReference()
+        if self.frame is not None:
+            # the grid is converted from / to longitude, latitude
+            gridCrs.ImportFromEPSG(4326)
+        else:
+            gridCrs.ImportFromWkt(self.gridCrs)
+        for crs in (rasterCrs, gridCrs):
+            crs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if self.frame is None and rasterCrs.IsSame(gridCrs):
+            return
+        self._toGrid = osr.CoordinateTransformation(rasterCrs, gridCrs)
+        self._toRaster = osr.CoordinateTransformation(gridCrs, rasterCrs)
+
+    def toGrid(self, x, y):
+        """
+        Converts arrays of raster CRS coordinates to grid coordinates
+        """
+        x, y = _transformPoints(self._toGrid, x, y)
+        if self.frame is not None:
+            return self.frame.toLocal(y, x)
+        return x, y
+
+    def toRaster(self, x, y):
+        """
+        Converts arrays of grid coordinates to raster CRS coordinates
+        """
+        if self.frame is not None:
+            lat, lon = self.frame.toWGS84(x, y)
+            x, y = lon, lat
+        return _transformPoints(self._toRaster, x, y)
+
+    def pixelWindow(self, grid):
+        """
+        Returns col0, col1, row0, row1 of the pixels covering grid (clipped to the raster); the
+        outline of the grid is sampled, so that curved or rotated transformations are covered
+        """
+        xmin, ymin, xmax, ymax = grid.xmin, grid.ymax - grid.rows * grid.size, \
+            grid.xmin + grid.cols * grid.size, grid.ymax
+        steps = np.linspace(0.0, 1.0, 9)
+        x = np.concatenate([xmin + steps * (xmax - xmin), np.full(9, xmax), xmax - steps * (xmax - xmin),
+                            np.full(9, xmin)])
+        y = np.concatenate([np.full(9, ymax), ymax - steps * (ymax - ymin), np.full(9, ymin),
+                            ymin + steps * (ymax - ymin)])
+        x, y = self.toRaster(x, y)
+        t = self.inverseTransform
+        cols = t[0] + t[1] * x + t[2] * y
+        rows = t[3] + t[4] * x + t[5] * y
+        # one pixel more, the sampled outline may cut corners
+        col0 = min(max(int(math.floor(cols.min())) - 1, 0), self.width)
+        col1 = min(max(int(math.ceil(cols.max())) + 1, 0), self.width)
+        row0 = min(max(int(math.floor(rows.min())) - 1, 0), self.height)
+        row1 = min(max(int(math.ceil(rows.max())) + 1, 0), self.height)
+        return col0, col1, row0, row1
+
+    def cellMask(self, grid):
+        """
+        Returns the weed cells of grid: all cells overlapped by a pixel at or above the
+        threshold (nodata pixels are ignored)
+        """
+        counts = np.zeros((grid.rows + 1, grid.cols + 1), dtype=np.int32)
+        col0, col1, row0, row1 = self.pixelWindow(grid)
+        if col1 > col0 and row1 > row0:
+            step = max(READ_PIXELS // (col1 - col0) // self.blockRows, 1) * self.blockRows
+            for top in range(row0, row1, step):
+                values = self._band.ReadAsArray(col0, top, col1 - col0, min(step, row1 - top))
+                weeds = values >= self.threshold
+                if self.nodata is not None:
+                    weeds &= values != self.nodata
+                rows, cols = np.nonzero(weeds)
+                if len(rows):
+                    self._markPixels(counts, grid, rows + top, cols + col0)
+        return counts.cumsum(axis=0).cumsum(axis=1)[:grid.rows, :grid.cols] > 0
+
+    def _markPixels(self, counts, grid, rows, cols):
+        """
+        Adds the footprints of pixels to counts (a 2D difference array of the grid cells)
+        """
+        t = self.geoTransform
+        cornerCols = cols[:, None] + np.array([0, 1, 0, 1])
+        cornerRows = rows[:, None] + np.array([0, 0, 1, 1])
+        x, y = self.toGrid((t[0] + t[1] * cornerCols + t[2] * cornerRows).ravel(),
+                           (t[3] + t[4] * cornerCols + t[5] * cornerRows).ravel())
+        x = np.asarray(x).reshape(-1, 4)
+        y = np.asarray(y).reshape(-1, 4)
+        # cells whose interior intersects the bounding box of the pixel
+        c0 = np.floor((x.min(axis=1) - grid.xmin) / grid.size).astype(np.int64)
+        c1 = np.ceil((x.max(axis=1) - grid.xmin) / grid.size).astype(np.int64)
+        r0 = np.floor((grid.ymax - y.max(axis=1)) / grid.size).astype(np.int64)
+        r1 = np.ceil((grid.ymax - y.min(axis=1)) / grid.size).astype(np.int64)
+        c0, c1 = np.clip(c0, 0, grid.cols), np.clip(c1, 0, grid.cols)
+        r0, r1 = np.clip(r0, 0, grid.rows), np.clip(r1, 0, grid.rows)
+        keep = (c1 > c0) & (r1 > r0)
+        c0, c1, r0, r1 = c0[keep], c1[keep], r0[keep], r1[keep]
+        np.add.at(counts, (r0, c0), 1)
+        np.add.at(counts, (r0, c1), -1)
+        np.add.at(counts, (r1, c0), -1)
+        np.add.at(counts, (r1, c1), 1)
+
+
+def readWeeds(path, frame, threshold=DEFAULT_THRESHOLD):
+    """
+    Reads a weed file: a raster (see RASTER_EXTENSIONS) as WeedRaster for a grid in the AOG
+    local coordinates of frame, otherwise the polygons of the file (see readPolygons)
+    """
+    if os.path.splitext(path)[1].lower() in RASTER_EXTENSIONS:
+        return WeedRaster(path, threshold, frame=frame)
+    return readPolygons(path)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""
+   The core library aogsections lives in scripts next to the QGIS processing script
+"""
+
+import os
+import sys
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+if SCRIPTS not in sys.path:
+    sys.path.insert(0, SCRIPTS)
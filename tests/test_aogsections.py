@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+   Checks of the core library on the example field in qgis/example: cached and tiled runs give
+   the same Sections.txt as a full run, Sections.txt files read back as written, and LocalFrame
+   matches the conversion of the original QGIS script
+"""
+
+import os
+from math import cos
+
+import numpy as np
+import pytest
+
+from aogsections import LocalFrame, generateSections, readPolygons, readSections
+from aogsections.sections import formatColor, formatSectionPatches, rectCorners, stripStarts
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'qgis', 'example')
+
+
+@pytest.fixture(scope='module')
+def field():
+    frame = LocalFrame.fromFieldFile(os.path.join(EXAMPLE, 'Field.txt'))
+    return (frame, readPolygons(os.path.join(EXAMPLE, 'Field.kml')),
+            readPolygons(os.path.join(EXAMPLE, 'weeds.shp')))
+
+
+def readText(path):
+    with open(path) as file:
+        return file.read()
+
+
+def cellPatches(path):
+    """
+    Returns the patches of a Sections.txt written without strips as sorted list of vertex tuples
+    """
+    patches = readSections(path)
+    assert (patches.counts == 5).all()
+    return sorted(map(tuple, patches.vertices.reshape(-1, 8).tolist()))
+
+
+@pytest.mark.parametrize('engine, gridSmall', [('mask', 1.0), ('quadtree', 0.5)])
+def test_cache_equals_full_run(field, tmp_path, engine, gridSmall):
+    frame, boundary, weeds = field
+    cached = str(tmp_path / 'cached.txt')
+    full = str(tmp_path / 'full.txt')
+    # weeds removed and one moved a little
+    changed = weeds[:5] + weeds[7:] + [[ring + [0.00002, 0.00001] for ring in weeds[0]]]
+    for current in (weeds, changed, weeds):
+        generateSections(boundary, current, frame, cached, gridSmall, engine=engine, cacheDir=str(tmp_path / 'cache'))
+        generateSections(boundary, current, frame, full, gridSmall, engine=engine)
+        assert readText(cached) == readText(full)
+
+
+def test_tiles_equal_full_run(field, tmp_path):
+    frame, boundary, weeds = field
+    # strips are not merged across tile borders, so the cells are compared one by one
+    generateSections(boundary, weeds, frame, str(tmp_path / 'full.txt'), mergeStrips=False)
+    generateSections(boundary, weeds, frame, str(tmp_path / 'tiled.txt'), mergeStrips=False, tileSize=100.0)
+    assert cellPatches(str(tmp_path / 'tiled.txt')) == cellPatches(str(tmp_path / 'full.txt'))
+
+
+def test_read_sections_round_trip(tmp_path):
+    # two rows of cells, partly adjacent, with coordinates that need rounding
+    left = np.array([0.0, 1.0, 2.0, 5.0, 0.0, 1.0]) + 1000.1234
+    top = np.array([0.0, 0.0, 0.0, 0.0, -1.0, -1.0]) - 200.5678
+    rects = np.column_stack([left, top, left + 1.0, top - 1.0])
+    starts = stripStarts(rects, maxCells=2)
+    path = tmp_path / 'Sections.txt'
+    path.write_text(formatSectionPatches(rectCorners(rects), starts, formatColor((0, 255, 0))))
+
+    patches = readSections(str(path))
+    assert patches.patchCount == int(starts.sum())
+    assert (patches.colors == [0, 255, 0]).all()
+    cells = np.diff(np.append(np.flatnonzero(starts), len(starts)))
+    assert patches.counts.tolist() == (2 * cells + 3).tolist()
+    # every strip is the left edge of its first cell followed by the right edge of every cell, top first
+    expected = []
+    for first, count in zip(np.flatnonzero(starts).tolist(), cells.tolist()):
+        strip = rects[first:first + count].tolist()
+        expected.extend([[strip[0][0], strip[0][1]], [strip[0][0], strip[0][3]]])
+        for _, top, right, bottom in strip:
+            expected.extend([[right, top], [right, bottom]])
+    assert patches.vertices.tolist() == np.round(expected, 3).tolist()
+
+
+def test_local_frame_matches_original_conversion(field):
+    frame, boundary, weeds = field
+    radians = 0.01745329251994329576923690766743
+    # conversion of the original QGIS script: meters per degree latitude at the StartFix,
+    # meters per degree longitude at every vertex with only the first two terms
+    mPerDegreeLat = 111132.92 - 559.82 * cos(2.0 * frame.latStart * radians) + 1.175 * cos(
+        4.0 * frame.latStart * radians) - 0.0023 * cos(6.0 * frame.latStart * radians)
+
+    def convert(lat, lon):
+        mPerDegreeLon = 111412.84 * cos(lat * radians) - 93.5 * cos(3.0 * lat * radians)
+        return (lon - frame.lonStart) * mPerDegreeLon, (lat - frame.latStart) * mPerDegreeLat
+
+    points = np.concatenate([ring for rings in boundary + weeds for ring in rings])
+    easting, northing = frame.toLocal(points[:, 1], points[:, 0])
+    expected = np.array([convert(lat, lon) for lon, lat in points.tolist()])
+    assert easting.tolist() == expected[:, 0].tolist()
+    assert northing.tolist() == expected[:, 1].tolist()